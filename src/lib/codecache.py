@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Chris Dekter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path, marshal, imp, hashlib, threading, logging, types
+
+_logger = logging.getLogger("codecache")
+
+CODE_FILE_EXTENSION = ".code"
+CODE_FILENAME = "<string>"
+
+
+class CodeCache:
+    """
+    Compiled code objects for script source, kept in memory and persisted to a directory
+    so they survive restarts.
+
+    Entries are keyed by a hash of the source and the interpreter's bytecode version, so
+    a changed script simply misses the cache and is compiled again.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.codeObjects = {}
+        self.lock = threading.Lock()
+
+    def get(self, source):
+        """
+        Get the compiled code for the given source, compiling it if it is not cached.
+
+        @param source: Python source code
+        @return: a code object that can be run using exec
+        @raise SyntaxError: if the source cannot be compiled
+        """
+        key = self.get_key(source)
+        with self.lock:
+            code = self.codeObjects.get(key)
+
+        if code is None:
+            code = self.__load(key)
+            if code is None:
+                code = compile(source, CODE_FILENAME, "exec")
+                self.__save(key, code)
+            with self.lock:
+                self.codeObjects[key] = code
+
+        return code
+
+    def get_key(self, source):
+        if isinstance(source, unicode):
+            source = source.encode("utf-8")
+        return hashlib.sha1(imp.get_magic() + source).hexdigest()
+
+    def prune(self, sources):
+        """
+        Remove all cached code except that for the given sources.
+
+        @param sources: source code of the scripts that are still in use
+        """
+        keep = set(self.get_key(source) for source in sources)
+        with self.lock:
+            for key in self.codeObjects.keys():
+                if key not in keep:
+                    del self.codeObjects[key]
+
+        if not os.path.isdir(self.directory):
+            return
+        for fileName in os.listdir(self.directory):
+            key, ext = os.path.splitext(fileName)
+            if ext == CODE_FILE_EXTENSION and key not in keep:
+                try:
+                    os.remove(os.path.join(self.directory, fileName))
+                except OSError:
+                    _logger.warning("Unable to remove stale cached code %s", fileName)
+
+    def __getPath(self, key):
+        return os.path.join(self.directory, key + CODE_FILE_EXTENSION)
+
+    def __load(self, key):
+        path = self.__getPath(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as inFile:
+                code = marshal.load(inFile)
+        except (IOError, EOFError, ValueError, TypeError):
+            code = None
+
+        if not isinstance(code, types.CodeType):
+            _logger.warning("Ignoring unreadable cached code %s", path)
+            return None
+        return code
+
+    def __save(self, key, code):
+        path = self.__getPath(key)
+        tempPath = "%s.%d.tmp" % (path, threading.current_thread().ident)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(tempPath, "wb") as outFile:
+                marshal.dump(code, outFile)
+            os.rename(tempPath, path)
+        except (IOError, OSError):
+            _logger.warning("Unable to save compiled code to %s", path)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Chris Dekter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import subprocess, threading, time, Queue, os, signal, logging
+from scheduler import check_cancelled
+
+_logger = logging.getLogger("command")
+
+# Lines of output buffered before a command's output pipe is left to fill up
+COMMAND_OUTPUT_BUFFER = 1000
+
+
+class CommandTimeoutError(Exception):
+    """
+    Raised when a shell command does not finish within its timeout. The command is killed.
+    """
+    pass
+
+
+class RunningCommand:
+    """
+    A shell command started by the System class, whose output is read as it is produced.
+    
+    The output can be consumed either line by line using L{lines} or all at once using
+    L{result}, but not both.
+    """
+    
+    def __init__(self, command, timeout=None):
+        self.command = command
+        self.timeout = timeout
+        self.retCode = None
+        self.timedOut = False
+        self.__abandoned = False
+        self.__output = Queue.Queue(COMMAND_OUTPUT_BUFFER)
+        self.__done = threading.Event()
+        # The command gets its own process group, so kill() also stops any processes it starts.
+        # setsid(1) creates it: a preexec_fn would run Python between fork and exec, which
+        # can deadlock a threaded process. The child is not a group leader, so setsid execs
+        # the shell in place and the group ID is the child's PID
+        self.__process = subprocess.Popen(["setsid", "/bin/sh", "-c", command], bufsize=1,
+                                          stdout=subprocess.PIPE)
+        self.__deadline = None
+        
+        if timeout is not None:
+            self.__deadline = time.time() + timeout
+            self.__timer = threading.Timer(timeout, self.__expire)
+            self.__timer.setDaemon(True)
+            self.__timer.start()
+        
+        # Reading in a separate thread means the pipe never fills up and blocks the command
+        t = threading.Thread(target=self.__read, name="Command-reader")
+        t.setDaemon(True)
+        t.start()
+        
+    def done(self):
+        """
+        Check whether the command has finished
+        
+        Usage: C{cmd.done()}
+        """
+        return self.__done.isSet()
+        
+    def lines(self):
+        """
+        Iterate over the lines of output as the command produces them, without their line endings
+        
+        Usage: C{for line in cmd.lines(): ...}
+        
+        @raise subprocess.CalledProcessError: once the output ends, if the command returned a non-zero exit code
+        @raise CommandTimeoutError: if the command did not finish within its timeout
+        """
+        try:
+            while True:
+                line = self.__next()
+                if line is None:
+                    break
+                yield line.rstrip("\n")
+        except:
+            self.__abandon()
+            raise
+        self.__checkResult('')
+    
+    def result(self, timeout=None):
+        """
+        Wait for the command to finish and get its output
+        
+        Usage: C{cmd.result(timeout=None)}
+        
+        @param timeout: maximum number of seconds to wait for, in addition to the command's own timeout
+        @return: the output of the command, minus the final line ending
+        @raise subprocess.CalledProcessError: if the command returns a non-zero exit code
+        @raise CommandTimeoutError: if the command did not finish in time
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        chunks = []
+        
+        try:
+            while True:
+                line = self.__next(deadline)
+                if line is None:
+                    break
+                chunks.append(line)
+        except:
+            self.__abandon()
+            raise
+        
+        output = ''.join(chunks)[:-1]
+        self.__checkResult(output)
+        return output
+        
+    def kill(self):
+        """
+        Stop the command if it is still running
+        
+        Usage: C{cmd.kill()}
+        """
+        if self.__process.poll() is None:
+            try:
+                os.killpg(self.__process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+                
+    def __abandon(self):
+        # Nothing will read the rest of the output
+        self.__abandoned = True
+        self.kill()
+        
+    def __expire(self):
+        if not self.done():
+            self.timedOut = True
+            self.kill()
+            
+    def __read(self):
+        for line in iter(self.__process.stdout.readline, ''):
+            self.__put(line)
+        self.retCode = self.__process.wait()
+        if self.timeout is not None:
+            self.__timer.cancel()
+        self.__done.set()
+        self.__put(None)
+        
+    def __put(self, item):
+        # Blocks while the buffer is full, unless nobody will read the output any more
+        while not self.__abandoned:
+            try:
+                self.__output.put(item, True, 0.1)
+                return
+            except Queue.Full:
+                pass
+        
+    def __next(self, deadline=None):
+        # Waits in short steps, so a script cancelled by the scheduler is interrupted. The
+        # caller then abandons the command, which kills it
+        while True:
+            check_cancelled()
+            try:
+                return self.__output.get(True, 0.1)
+            except Queue.Empty:
+                if deadline is not None and time.time() > deadline:
+                    raise CommandTimeoutError("Command '%s' did not finish in time" % self.command)
+                    
+    def __checkResult(self, output):
+        if self.timedOut:
+            raise CommandTimeoutError("Command '%s' timed out after %gs" % (self.command, self.timeout))
+        if self.retCode != 0:
+            raise subprocess.CalledProcessError(self.retCode, output)
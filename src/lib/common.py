@@ -17,6 +17,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os.path, dbus.service
+import latency
 
 CONFIG_DIR = os.path.expanduser("~/.config/autokey")
 LOCK_FILE = CONFIG_DIR + "/autokey.pid"
@@ -66,3 +67,19 @@ class AppService(dbus.service.Object):
     @dbus.service.method(dbus_interface='org.autokey.Service', in_signature='s', out_signature='')
     def run_folder(self, name):
         self.app.service.run_folder(name)
+
+    @dbus.service.method(dbus_interface='org.autokey.Service', in_signature='', out_signature='a{sa{sd}}')
+    def get_latency_stats(self):
+        return latency.get_stats()
+
+    @dbus.service.method(dbus_interface='org.autokey.Service', in_signature='', out_signature='')
+    def reset_latency_stats(self):
+        latency.reset()
+
+    @dbus.service.method(dbus_interface='org.autokey.Service', in_signature='', out_signature='a(issd)')
+    def list_running_scripts(self):
+        return self.app.service.scriptRunner.list_running()
+
+    @dbus.service.method(dbus_interface='org.autokey.Service', in_signature='i', out_signature='b')
+    def cancel_script(self, jobId):
+        return self.app.service.scriptRunner.cancel(jobId)
@@ -16,7 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os, os.path, shutil, logging, pickle, glob, threading, subprocess
-import iomediator, interface, common, monitor
+import iomediator, interface, common, monitor, matcher
 
 try:
     import json
@@ -29,6 +29,7 @@ _logger = logging.getLogger("config-manager")
 CONFIG_DIR = os.path.expanduser("~/.config/autokey")
 CONFIG_FILE = os.path.join(CONFIG_DIR, "autokey.json")
 CONFIG_DEFAULT_FOLDER = os.path.join(CONFIG_DIR, "data")
+CONFIG_CODE_CACHE_FOLDER = os.path.join(CONFIG_DIR, "codecache")
 CONFIG_FILE_BACKUP = CONFIG_FILE + '~'
 
 DEFAULT_ABBR_FOLDER = "Imported Abbreviations"
@@ -53,6 +54,12 @@ SHOW_TOOLBAR = "showToolbar"
 NOTIFICATION_ICON = "notificationIcon"
 WORKAROUND_APP_REGEX = "workAroundApps"
 SCRIPT_GLOBALS = "scriptGlobals"
+SCRIPT_WORKERS = "scriptWorkers"
+MACRO_TIMEOUT = "macroTimeout"
+ISOLATED_SCRIPT_WORKERS = "isolatedScriptWorkers"
+SCRIPT_TIMEOUT = "scriptTimeout"
+SEND_BATCH_SIZE = "sendBatchSize"
+SEND_BATCH_DELAY = "sendBatchDelay"
 
 # TODO - Future functionality
 #TRACK_RECENT_ENTRY = "trackRecentEntry"
@@ -182,7 +189,21 @@ class ConfigManager:
                 #RECENT_ENTRY_COUNT : 5,
                 #RECENT_ENTRY_MINLENGTH : 10,
                 #RECENT_ENTRY_SUGGEST : True
-                SCRIPT_GLOBALS : {}
+                SCRIPT_GLOBALS : {},
+                SCRIPT_WORKERS : 4,
+                # Seconds to wait for the <script> macros in a phrase before the expansion
+                # is abandoned (0 = wait until they finish)
+                MACRO_TIMEOUT : 0,
+                # Worker processes for scripts marked as isolated (0 = run them in-process).
+                # They are forked at startup, so none are started unless asked for.
+                ISOLATED_SCRIPT_WORKERS : 0,
+                # Seconds after which a running script is cancelled, unless the script sets
+                # its own timeout (0 = no limit)
+                SCRIPT_TIMEOUT : 0,
+                # Output pacing: flush every N characters (0 = whole string at once)
+                # then pause for the given number of milliseconds
+                SEND_BATCH_SIZE : 0,
+                SEND_BATCH_DELAY : 0
                 }
                 
     def __init__(self, app):
@@ -536,67 +557,44 @@ dialog.info_dialog("Window information",
         """
         _logger.info("Configuration changed - rebuilding in-memory structures")
         
+        # Only writers take the lock. Readers such as the keypress handler use whichever
+        # snapshot is current, so they never wait for a rebuild or for the save below.
         self.lock.acquire()
-        # Rebuild root folder list
-        #rootFolders = self.folders
-        #self.folders = []
-        #for folder in rootFolders:
-        #    self.folders.append(folder)
-        
-        self.hotKeyFolders = []
-        self.hotKeys = []
-        
-        self.abbreviations = []
-        
-        self.allFolders = []
-        self.allItems = []
-        
-        for folder in self.folders:
-            if TriggerMode.HOTKEY in folder.modes:
-                self.hotKeyFolders.append(folder)
-            self.allFolders.append(folder)
+        try:
+            for folder in self.__walkFolders(self.folders):
+                if not self.app.monitor.has_watch(folder.path):
+                    self.app.monitor.add_watch(folder.path)
             
-            if not self.app.monitor.has_watch(folder.path):
-                self.app.monitor.add_watch(folder.path)
+            snapshot = ConfigSnapshot(self.folders, [self.configHotkey, self.toggleServiceHotkey])
             
-            self.__processFolder(folder)
-        
-        self.globalHotkeys = []
-        self.globalHotkeys.append(self.configHotkey)
-        self.globalHotkeys.append(self.toggleServiceHotkey)
-        #_logger.debug("Global hotkeys: %s", self.globalHotkeys)
-        
-        #_logger.debug("Hotkey folders: %s", self.hotKeyFolders)
-        #_logger.debug("Hotkey phrases: %s", self.hotKeys)
-        #_logger.debug("Abbreviation phrases: %s", self.abbreviations)
-        #_logger.debug("All folders: %s", self.allFolders)
-        #_logger.debug("All phrases: %s", self.allItems)
-        
-        if persistGlobal:
-            save_config(self)
-
-        self.lock.release()
-                    
-    def __processFolder(self, parentFolder):        
-        if not self.app.monitor.has_watch(parentFolder.path):
-            self.app.monitor.add_watch(parentFolder.path)
-        
-        for folder in parentFolder.folders:
-            if TriggerMode.HOTKEY in folder.modes:
-                self.hotKeyFolders.append(folder)
-            self.allFolders.append(folder)
+            # Publish the new snapshot with a single reference assignment
+            self.snapshot = snapshot
+            self.hotKeyFolders = snapshot.hotKeyFolders
+            self.hotKeys = snapshot.hotKeys
+            self.abbreviations = snapshot.abbreviations
+            self.abbrFolders = snapshot.abbrFolders
+            self.allFolders = snapshot.allFolders
+            self.allItems = snapshot.allItems
+            self.globalHotkeys = snapshot.globalHotkeys
             
-            if not self.app.monitor.has_watch(folder.path):
-                self.app.monitor.add_watch(folder.path)
+            #_logger.debug("Global hotkeys: %s", self.globalHotkeys)
             
-            self.__processFolder(folder)
+            #_logger.debug("Hotkey folders: %s", self.hotKeyFolders)
+            #_logger.debug("Hotkey phrases: %s", self.hotKeys)
+            #_logger.debug("Abbreviation phrases: %s", self.abbreviations)
+            #_logger.debug("All folders: %s", self.allFolders)
+            #_logger.debug("All phrases: %s", self.allItems)
             
-        for item in parentFolder.items:
-            if TriggerMode.HOTKEY in item.modes:
-                self.hotKeys.append(item)
-            if TriggerMode.ABBREVIATION in item.modes:
-                self.abbreviations.append(item)
-            self.allItems.append(item)
+            if persistGlobal:
+                save_config(self)
+        finally:
+            self.lock.release()
+                    
+    def __walkFolders(self, folders):
+        for folder in folders:
+            yield folder
+            for subFolder in self.__walkFolders(folder.folders):
+                yield subFolder
             
     # TODO Future functionality
     def add_recent_entry(self, entry):
@@ -708,6 +706,60 @@ dialog.info_dialog("Window information",
 
         return True, None
     
+class ConfigSnapshot:
+    """
+    Immutable view of the trigger configuration, used by the keypress handler.
+    
+    A new snapshot is built each time the configuration is altered and then swapped in
+    whole, so a reader holding a reference always sees one consistent configuration.
+    Neither the snapshot nor its sequences are modified once it has been built.
+    """
+    
+    def __init__(self, folders, globalHotkeys):
+        """
+        @param folders: the top-level folders of the configuration
+        @param globalHotkeys: the application's global hotkeys
+        """
+        self.hotKeyFolders = []
+        self.hotKeys = []
+        self.abbrFolders = []
+        self.abbreviations = []
+        self.allFolders = []
+        self.allItems = []
+        
+        for folder in folders:
+            self.__addFolder(folder)
+        
+        self.abbreviationIndex = matcher.AbbreviationIndex(self.abbrFolders, self.abbreviations)
+        self.hotkeyIndex = matcher.HotkeyIndex(globalHotkeys, self.hotKeys, self.hotKeyFolders)
+        self.windowFilterIndex = matcher.WindowFilterIndex(self.abbrFolders + self.abbreviations +
+                                                           self.hotKeyFolders + self.hotKeys)
+        
+        self.hotKeyFolders = tuple(self.hotKeyFolders)
+        self.hotKeys = tuple(self.hotKeys)
+        self.abbrFolders = tuple(self.abbrFolders)
+        self.abbreviations = tuple(self.abbreviations)
+        self.allFolders = tuple(self.allFolders)
+        self.allItems = tuple(self.allItems)
+        self.globalHotkeys = tuple(globalHotkeys)
+        
+    def __addFolder(self, folder):
+        if TriggerMode.HOTKEY in folder.modes:
+            self.hotKeyFolders.append(folder)
+        if TriggerMode.ABBREVIATION in folder.modes:
+            self.abbrFolders.append(folder)
+        self.allFolders.append(folder)
+        
+        for subFolder in folder.folders:
+            self.__addFolder(subFolder)
+            
+        for item in folder.items:
+            if TriggerMode.HOTKEY in item.modes:
+                self.hotKeys.append(item)
+            if TriggerMode.ABBREVIATION in item.modes:
+                self.abbreviations.append(item)
+            self.allItems.append(item)
+
 # This import placed here to prevent circular import conflicts
 from model import *
 
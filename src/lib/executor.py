@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Chris Dekter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading, Queue, logging, time
+import latency
+
+_logger = logging.getLogger("executor")
+
+DEFAULT_SHUTDOWN_TIMEOUT = 5.0
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class Future:
+    """
+    The pending result of a task submitted using WorkerPool.submit_future().
+    """
+
+    def __init__(self):
+        self.__done = threading.Event()
+        self.__result = None
+        self.__error = None
+
+    def run(self, func, args):
+        try:
+            self.__result = func(*args)
+        except Exception, e:
+            self.__error = e
+            raise
+        finally:
+            self.__done.set()
+
+    def cancel(self, error):
+        """
+        Complete the future with the given error, if it has not already completed.
+        """
+        if not self.__done.isSet():
+            self.__error = error
+            self.__done.set()
+
+    def done(self):
+        return self.__done.isSet()
+
+    def result(self, timeout=None):
+        """
+        Wait for the task to complete.
+
+        @param timeout: maximum number of seconds to wait, or None to wait indefinitely
+        @return: the value returned by the task
+        @raise TimeoutError: if the task did not complete in time
+        @raise Exception: the error raised by the task, if it failed
+        """
+        if not self.__done.wait(timeout):
+            raise TimeoutError("Task did not complete within %gs" % timeout)
+        if self.__error is not None:
+            raise self.__error
+        return self.__result
+
+
+class WorkerPool:
+    """
+    Runs submitted tasks on a fixed set of long-lived worker threads.
+
+    Tasks are taken from a single FIFO queue, so a pool with one worker runs them
+    strictly in submission order (used as the serial lane for keyboard output).
+    """
+
+    def __init__(self, name, workers=1, stage=None):
+        """
+        @param name: name used for the worker threads and in log messages
+        @param workers: number of worker threads to start
+        @param stage: if given, the latency stage under which to record each task's queueing time
+        """
+        self.name = name
+        self.stage = stage
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.peakDepth = 0
+        self.shuttingDown = False
+        self.workers = []
+
+        for i in xrange(max(1, workers)):
+            t = threading.Thread(target=self.__run, name="%s-worker-%d" % (name, i))
+            t.setDaemon(True)
+            t.start()
+            self.workers.append(t)
+
+    def submit(self, func, *args):
+        """
+        Queue a call to func(*args) to be run by the next free worker.
+
+        @return: False if the pool has been shut down and the task was dropped
+        """
+        with self.lock:
+            if self.shuttingDown:
+                _logger.warning("%s pool shut down - dropping task %r", self.name, func)
+                return False
+            self.submitted += 1
+            self.queue.put_nowait((func, args, latency.now()))
+            self.peakDepth = max(self.peakDepth, self.queue.qsize())
+        return True
+
+    def submit_future(self, func, *args):
+        """
+        Queue a call to func(*args), returning a Future for its result.
+
+        @return: a Future that completes when the task has run
+        """
+        future = Future()
+        if not self.submit(future.run, func, args):
+            future.cancel(RuntimeError("%s pool has been shut down" % self.name))
+        return future
+
+    def get_queue_depth(self):
+        """
+        @return: the number of tasks waiting for a free worker
+        """
+        return self.queue.qsize()
+
+    def get_stats(self):
+        """
+        @return: a dictionary of the pool's queue and task counters
+        """
+        with self.lock:
+            return {
+                    "workers": len(self.workers),
+                    "queued": self.queue.qsize(),
+                    "active": self.active,
+                    "peakQueued": self.peakDepth,
+                    "submitted": self.submitted,
+                    "completed": self.completed,
+                    "failed": self.failed
+                    }
+
+    def shutdown(self, timeout=DEFAULT_SHUTDOWN_TIMEOUT):
+        """
+        Stop accepting tasks and wait for the workers to finish the tasks already queued.
+
+        @param timeout: maximum number of seconds to wait for all workers to exit
+        """
+        with self.lock:
+            if self.shuttingDown:
+                return
+            self.shuttingDown = True
+            for t in self.workers:
+                self.queue.put_nowait((None, None, None))
+
+        deadline = time.time() + timeout
+        for t in self.workers:
+            t.join(max(0, deadline - time.time()))
+            if t.isAlive():
+                _logger.warning("%s pool worker %s did not finish before shutdown", self.name, t.getName())
+
+    def __run(self):
+        while True:
+            func, args, queuedAt = self.queue.get()
+            if func is None:
+                break
+            if self.stage is not None:
+                latency.record_since(self.stage, queuedAt)
+
+            with self.lock:
+                self.active += 1
+            try:
+                func(*args)
+            except Exception:
+                _logger.exception("Unhandled error in %s pool task", self.name)
+                with self.lock:
+                    self.failed += 1
+            with self.lock:
+                self.active -= 1
+                self.completed += 1
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Chris Dekter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path, threading, collections, logging
+
+_logger = logging.getLogger("filecache")
+
+# Total size of the file contents kept in memory for <file> macros
+MAX_CACHED_FILE_BYTES = 32 * 1024 * 1024
+
+
+class FileContentsCache:
+    """
+    Holds the contents of recently inserted files, checked against each file's
+    modification time and size before use.
+    
+    The contents are kept as strings, which the expansion is built from anyway, so a
+    cached file is returned without being copied. Entries are evicted least recently
+    used first once their total size exceeds maxBytes.
+    """
+    
+    def __init__(self, maxBytes=MAX_CACHED_FILE_BYTES):
+        self.maxBytes = maxBytes
+        self.entries = collections.OrderedDict() # path -> ((mtime, size), contents)
+        self.cachedBytes = 0
+        self.lock = threading.Lock()
+        
+    def read(self, path):
+        """
+        @return: the contents of the file at the given path
+        """
+        path = os.path.abspath(os.path.expanduser(path))
+        st = os.stat(path)
+        key = (st.st_mtime, st.st_size)
+        
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                if entry[0] == key:
+                    self.entries[path] = entry
+                    return entry[1]
+                self.cachedBytes -= entry[0][1]
+        
+        key, contents = self.__load(path)
+        if key[1] > self.maxBytes:
+            return contents
+        
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.cachedBytes -= old[0][1]
+            self.entries[path] = (key, contents)
+            self.cachedBytes += key[1]
+            while self.cachedBytes > self.maxBytes:
+                self.cachedBytes -= self.entries.popitem(last=False)[1][0][1]
+            return contents
+            
+    def __load(self, path):
+        with open(path, "r") as inputFile:
+            # Key the contents by the file as it was opened, in case it has just changed
+            st = os.fstat(inputFile.fileno())
+            contents = inputFile.read()
+        return (st.st_mtime, len(contents)), contents
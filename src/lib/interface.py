@@ -18,7 +18,7 @@
 __all__ = ["XRecordInterface", "AtSpiInterface"]
 
 
-import os, threading, re, time, socket, select, logging, Queue, subprocess
+import os, threading, re, time, socket, select, logging, Queue, subprocess, collections
 
 try:
     import pyatspi
@@ -26,7 +26,7 @@ try:
 except ImportError:
     HAS_ATSPI = False
 
-from Xlib import X, XK, display, error
+from Xlib import X, XK, Xatom, display, error
 try:
     from Xlib.ext import record, xtest
     HAS_RECORD = True
@@ -35,7 +35,7 @@ except ImportError:
     
 from Xlib.protocol import rq, event
 
-import common
+import common, latency
 if common.USING_QT:
     from PyQt4.QtGui import QClipboard, QApplication
 else:
@@ -57,6 +57,20 @@ MASK_INDEXES = [
 CAPSLOCK_LEDMASK = 1<<0
 NUMLOCK_LEDMASK = 1<<1
 
+# Size of the precomputed keycode lookup table: every keycode at each
+# combination of shift (1), numlock (2) and AltGr (4)
+MAX_KEYCODE = 255
+LOOKUP_LEVELS = 8
+
+# Each remap of spare keycodes we make ourselves produces a keymap change notification
+# that is ignored. One that has not arrived after this long is no longer waited for,
+# as the server may have reported several remaps in a single notification.
+REMAP_SETTLE_TIME = 1.0
+
+# Hotkeys are grabbed in a new window once it has had this long to set its title,
+# unless it has been destroyed by then
+NEW_WINDOW_GRAB_DELAY = 1.0
+
 class XInterfaceBase(threading.Thread):
     """
     Encapsulates the common functionality for the two X interface classes.
@@ -96,14 +110,22 @@ class XInterfaceBase(threading.Thread):
         self.__NameAtom = self.localDisplay.intern_atom("_NET_WM_NAME", True)
         self.__VisibleNameAtom = self.localDisplay.intern_atom("_NET_WM_VISIBLE_NAME", True)
         
+        self.focusTracker = FocusTracker(self.__lookupFocusInfo)
+        
         if not common.USING_QT:
             self.keyMap = Gdk.Keymap.get_default()
             self.keyMap.connect("keys-changed", self.on_keys_changed)
         
         self.__ignoreRemap = False
+        self.__remapLock = threading.Lock()
+        self.__pendingRemaps = 0
+        self.__lastRemap = 0
+        
+        self.windowTable = WindowTable(self.localDisplay, self.get_window_title, self.get_window_class)
         
         self.eventThread.start()
         self.listenerThread.start()
+        self.focusTracker.start()
         
     def __eventLoop(self):
         while True:
@@ -123,7 +145,9 @@ class XInterfaceBase(threading.Thread):
         self.queue.put_nowait((method, args))
 
     def on_keys_changed(self, data=None):
-        if not self.__ignoreRemap:
+        if self.__isOwnRemap():
+            logger.debug("Ignored keymap change event caused by remapping spare keycodes")
+        elif not self.__ignoreRemap:
             logger.debug("Recorded keymap change event")
             self.__ignoreRemap = True
             time.sleep(0.2)
@@ -132,6 +156,19 @@ class XInterfaceBase(threading.Thread):
         else:
             logger.debug("Ignored keymap change event")
 
+    def __isOwnRemap(self):
+        """
+        Check whether a keymap change notification is the result of one of our own
+        remaps, rather than e.g. the user switching keyboard layout.
+        """
+        with self.__remapLock:
+            if self.__pendingRemaps > 0 and time.time() - self.__lastRemap > REMAP_SETTLE_TIME:
+                self.__pendingRemaps = 0
+            if self.__pendingRemaps > 0:
+                self.__pendingRemaps -= 1
+                return True
+            return False
+
     def __delayedInitMappings(self):        
         self.__initMappings()
         self.__ignoreRemap = False
@@ -139,7 +176,10 @@ class XInterfaceBase(threading.Thread):
     def __initMappings(self):
         self.localDisplay = display.Display()
         self.rootWindow = self.localDisplay.screen().root
-        self.rootWindow.change_attributes(event_mask=X.SubstructureNotifyMask|X.StructureNotifyMask)
+        self.rootWindow.change_attributes(event_mask=X.SubstructureNotifyMask|X.StructureNotifyMask|X.PropertyChangeMask)
+        if getattr(self, "windowTable", None) is not None:
+            # Event masks on client windows belong to the old connection
+            self.windowTable.reset()
         
         altList = self.localDisplay.keysym_to_keycodes(XK.XK_ISO_Level3_Shift)
         self.__usableOffsets = (0, 1)
@@ -169,6 +209,9 @@ class XInterfaceBase(threading.Thread):
 
         logger.debug("Modifier masks: %r", self.modMasks)
 
+        self.__buildLookupTable()
+        self.__clearKeyCodeCache()
+
         self.__grabHotkeys()
         self.localDisplay.flush()
 
@@ -188,8 +231,13 @@ class XInterfaceBase(threading.Thread):
 
             keyCode += 1
 
+        # Keycodes already in the spare pool have our own characters mapped to them,
+        # but are still ours to reuse
+        if hasattr(self, "keycodePool"):
+            avail = sorted(set(avail) | set(self.keycodePool.keyCodes))
+
         self.__availableKeycodes = avail
-        self.remappedChars = {}
+        self.keycodePool = SpareKeycodePool(avail[:-1])
 
         if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
             self.keymap_test()
@@ -453,7 +501,32 @@ class XInterfaceBase(threading.Thread):
         except Exception, e:
             logger.warn("Failed to ungrab hotkey %r %r: %s", modifiers, key, str(e))
 
+    def __buildLookupTable(self):
+        """
+        Precompute the string for every keycode at every shift/numlock/AltGr level,
+        along with the modifier (if any) each keycode produces. The tables are built
+        in full before being swapped in, so lookups never see a partial table.
+        """
+        table = []
+        modifierKeys = {}
+        for keyCode in xrange(MAX_KEYCODE + 1):
+            for level in xrange(LOOKUP_LEVELS):
+                table.append(self.__lookupString(keyCode, level & 1, level & 2, level & 4))
+
+            keyName = table[keyCode * LOOKUP_LEVELS]
+            if keyName in MODIFIERS:
+                modifierKeys[keyCode] = keyName
+
+        self.__lookupTable = table
+        self.__modifierKeys = modifierKeys
+
     def lookup_string(self, keyCode, shifted, numlock, altGrid):
+        if 0 <= keyCode <= MAX_KEYCODE:
+            level = (shifted and 1 or 0) + (numlock and 2 or 0) + (altGrid and 4 or 0)
+            return self.__lookupTable[keyCode * LOOKUP_LEVELS + level]
+        return self.__lookupString(keyCode, shifted, numlock, altGrid)
+
+    def __lookupString(self, keyCode, shifted, numlock, altGrid):
         if keyCode == 0:
             return "<unknown>"
 
@@ -558,6 +631,27 @@ class XInterfaceBase(threading.Thread):
         self.localDisplay.ungrab_keyboard(X.CurrentTime)
         self.localDisplay.flush()
 
+    def __clearKeyCodeCache(self):
+        self.__charCache = {}
+        self.__keyNameCache = {}
+
+    def __resolveChar(self, char):
+        """
+        Find a keycode that produces the given character in the current keymap.
+        Results are cached until the keymap changes.
+
+        @return: a (keyCode, offset) tuple, or (None, None) if no usable keycode exists
+        """
+        try:
+            return self.__charCache[char]
+        except KeyError:
+            # Spare keycodes are reassigned as needed, so are never a permanent answer
+            keyCodeList = [(code, offset) for code, offset in self.localDisplay.keysym_to_keycodes(ord(char))
+                           if code not in self.keycodePool.keyCodes]
+            result = self.__findUsableKeycode(keyCodeList)
+            self.__charCache[char] = result
+            return result
+
     def __findUsableKeycode(self, codeList):
         for code, offset in codeList:
             if offset in self.__usableOffsets:
@@ -568,7 +662,24 @@ class XInterfaceBase(threading.Thread):
     def send_string(self, string):
         self.__enqueue(self.__sendString, string)
         
-    def __sendString(self, string):
+    def send_compiled(self, ops):
+        """
+        Send the operations of a compiled expansion (see L{IoMediator.compile_string})
+        as a single task, writing all of their events out with one flush at the end.
+        """
+        self.__enqueue(self.__sendCompiled, ops)
+        
+    def __sendCompiled(self, ops):
+        for op in ops:
+            if op[0] == SEND_TEXT:
+                self.__sendString(op[1], False)
+            elif op[0] == SEND_KEY:
+                self.__sendKey(op[1], False)
+            else:
+                self.__sendModifiedKey(op[1], list(op[2]), False)
+        self.localDisplay.flush()
+        
+    def __sendString(self, string, flush=True):
         """
         Send a string of printable characters.
         """
@@ -577,93 +688,82 @@ class XInterfaceBase(threading.Thread):
         if not ConfigManager.SETTINGS[ENABLE_QT4_WORKAROUND]:
             self.__checkWorkaroundNeeded()
 
-        # First find out if any chars need remapping
-        remapNeeded = False
+        # Characters missing from the keyboard map are sent using spare keycodes. The
+        # pool keeps its assignments between sends, so the keyboard mapping only needs
+        # changing when a character not already assigned turns up.
+        remapChars = []
         for char in string:
-            keyCodeList = self.localDisplay.keysym_to_keycodes(ord(char))
-            usableCode, offset = self.__findUsableKeycode(keyCodeList)
-            if usableCode is None and char not in self.remappedChars:
-                remapNeeded = True
-                break
-
-        # Now we know chars need remapping, do it
-        if remapNeeded:
-            self.__ignoreRemap = True
-            self.remappedChars = {}
-            remapChars = []
-
-            for char in string:
-                keyCodeList = self.localDisplay.keysym_to_keycodes(ord(char))
-                usableCode, offset = self.__findUsableKeycode(keyCodeList)
-                if usableCode is None:
-                    remapChars.append(char)
-
-            logger.debug("Characters requiring remapping: %r", remapChars)
-            availCodes = self.__availableKeycodes
-            logger.debug("Remapping with keycodes in the range: %r", availCodes)
-            mapping = self.localDisplay.get_keyboard_mapping(8, 200)
-            firstCode = 8
-
-            for i in xrange(len(availCodes) - 1):
-                code = availCodes[i]
-                sym1 = 0
-                sym2 = 0
-
-                if len(remapChars) > 0:
-                    char = remapChars.pop(0)
-                    self.remappedChars[char] = (code, 0)
-                    sym1 = ord(char)
-                if len(remapChars) > 0:
-                    char = remapChars.pop(0)
-                    self.remappedChars[char] = (code, 1)
-                    sym2 = ord(char)
-
-                if sym1 != 0:
-                    mapping[code - firstCode][0] = sym1
-                    mapping[code - firstCode][1] = sym2
-
-            mapping = [tuple(l) for l in mapping]
-            self.localDisplay.change_keyboard_mapping(firstCode, mapping)
-            self.localDisplay.flush()
-
+            usableCode, offset = self.__resolveChar(char)
+            if usableCode is None and char not in remapChars:
+                remapChars.append(char)
+
+        if len(remapChars) > 0:
+            changedCodes = self.keycodePool.assign(remapChars)
+            if len(changedCodes) > 0:
+                logger.debug("Remapping keycodes %r for characters %r", changedCodes, remapChars)
+                self.__remapKeycodes(changedCodes)
+
+        # Resolve the focus window once; the events for the whole string are then
+        # buffered on the connection and written out by a single flush at the end
         focus = self.localDisplay.get_input_focus().focus
+        self.__resetPacing()
 
         for char in string:
             try:
-                keyCodeList = self.localDisplay.keysym_to_keycodes(ord(char))
-                keyCode, offset = self.__findUsableKeycode(keyCodeList)
+                keyCode, offset = self.__resolveChar(char)
                 if keyCode is not None:
                     if offset == 0:
                         self.__sendKeyCode(keyCode, theWindow=focus)
                     if offset == 1:
-                        self.__pressKey(Key.SHIFT)
+                        self.__pressKey(Key.SHIFT, focus)
                         self.__sendKeyCode(keyCode, self.modMasks[Key.SHIFT], focus)
-                        self.__releaseKey(Key.SHIFT)
+                        self.__releaseKey(Key.SHIFT, focus)
                     if offset == 4:
-                        self.__pressKey(Key.ALT_GR)
+                        self.__pressKey(Key.ALT_GR, focus)
                         self.__sendKeyCode(keyCode, self.modMasks[Key.ALT_GR], focus)
-                        self.__releaseKey(Key.ALT_GR)
+                        self.__releaseKey(Key.ALT_GR, focus)
                     if offset == 5:
-                        self.__pressKey(Key.ALT_GR)
-                        self.__pressKey(Key.SHIFT)
+                        self.__pressKey(Key.ALT_GR, focus)
+                        self.__pressKey(Key.SHIFT, focus)
                         self.__sendKeyCode(keyCode, self.modMasks[Key.ALT_GR]|self.modMasks[Key.SHIFT], focus)
-                        self.__releaseKey(Key.SHIFT)
-                        self.__releaseKey(Key.ALT_GR)
+                        self.__releaseKey(Key.SHIFT, focus)
+                        self.__releaseKey(Key.ALT_GR, focus)
 
-                elif char in self.remappedChars:
-                    keyCode, offset = self.remappedChars[char]
+                elif self.keycodePool.get(char) is not None:
+                    keyCode, offset = self.keycodePool.get(char)
                     if offset == 0:
                         self.__sendKeyCode(keyCode, theWindow=focus)
                     if offset == 1:
-                        self.__pressKey(Key.SHIFT)
+                        self.__pressKey(Key.SHIFT, focus)
                         self.__sendKeyCode(keyCode, self.modMasks[Key.SHIFT], focus)
-                        self.__releaseKey(Key.SHIFT)
+                        self.__releaseKey(Key.SHIFT, focus)
                 else:
                     logger.warn("Unable to send character %r", char)
             except Exception, e:
                 logger.exception("Error sending char %r: %s", char, str(e))
 
-        self.__ignoreRemap = False
+            self.__pace()
+
+        if flush:
+            self.localDisplay.flush()
+
+    def __remapKeycodes(self, keyCodes):
+        """
+        Write the spare pool's current characters for the given keycodes to the keyboard
+        mapping, using a single change request.
+        """
+        with self.__remapLock:
+            self.__pendingRemaps += 1
+            self.__lastRemap = time.time()
+        first = min(keyCodes)
+        mapping = self.localDisplay.get_keyboard_mapping(first, max(keyCodes) - first + 1)
+        for keyCode in keyCodes:
+            sym1, sym2 = self.keycodePool.get_keysyms(keyCode)
+            mapping[keyCode - first][0] = sym1
+            mapping[keyCode - first][1] = sym2
+
+        self.localDisplay.change_keyboard_mapping(first, [tuple(l) for l in mapping])
+        self.localDisplay.flush()
 
 
     def send_key(self, keyName):
@@ -672,9 +772,28 @@ class XInterfaceBase(threading.Thread):
         """
         self.__enqueue(self.__sendKey, keyName)
         
-    def __sendKey(self, keyName):
+    def __sendKey(self, keyName, flush=True):
         logger.debug("Send special key: [%r]", keyName)
         self.__sendKeyCode(self.__lookupKeyCode(keyName))
+        if flush:
+            self.localDisplay.flush()
+
+    def send_repeated_key(self, keyName, count):
+        """
+        Send a non-printing key the given number of times, eg to delete a typed abbreviation
+        """
+        if count > 0:
+            self.__enqueue(self.__sendRepeatedKey, keyName, count)
+
+    def __sendRepeatedKey(self, keyName, count):
+        logger.debug("Send special key %d times: [%r]", count, keyName)
+        keyCode = self.__lookupKeyCode(keyName)
+        focus = self.localDisplay.get_input_focus().focus
+        self.__resetPacing()
+        for i in xrange(count):
+            self.__sendKeyCode(keyCode, theWindow=focus)
+            self.__pace()
+        self.localDisplay.flush()
 
     def fake_keypress(self, keyName):
          self.__enqueue(self.__fakeKeypress, keyName)
@@ -704,16 +823,19 @@ class XInterfaceBase(threading.Thread):
         """
         self.__enqueue(self.__sendModifiedKey, keyName, modifiers)
         
-    def __sendModifiedKey(self, keyName, modifiers):
+    def __sendModifiedKey(self, keyName, modifiers, flush=True):
         logger.debug("Send modified key: modifiers: %s key: %s", modifiers, keyName)
         try:
             mask = 0
             for mod in modifiers:
                 mask |= self.modMasks[mod]
             keyCode = self.__lookupKeyCode(keyName)
-            for mod in modifiers: self.__pressKey(mod)
-            self.__sendKeyCode(keyCode, mask)
-            for mod in modifiers: self.__releaseKey(mod)
+            focus = self.localDisplay.get_input_focus().focus
+            for mod in modifiers: self.__pressKey(mod, focus)
+            self.__sendKeyCode(keyCode, mask, focus)
+            for mod in modifiers: self.__releaseKey(mod, focus)
+            if flush:
+                self.localDisplay.flush()
         except Exception, e:
             logger.warn("Error sending modified key %r %r: %s", modifiers, keyName, str(e))
 
@@ -763,37 +885,66 @@ class XInterfaceBase(threading.Thread):
         self.localDisplay.flush()
         self.lastChars = []
 
+    def __resetPacing(self):
+        self.__pacingCount = 0
+
+    def __pace(self):
+        """
+        Apply the output pacing policy after each character or key has been buffered.
+
+        With a batch size of 0 nothing is written until the whole string has been buffered.
+        Otherwise the buffered events are flushed after every 'batch size' characters and
+        output pauses for the configured delay, for applications that drop events which
+        arrive too quickly.
+        """
+        batchSize = ConfigManager.SETTINGS[SEND_BATCH_SIZE]
+        if batchSize > 0:
+            self.__pacingCount += 1
+            if self.__pacingCount >= batchSize:
+                self.__pacingCount = 0
+                self.localDisplay.flush()
+                delay = ConfigManager.SETTINGS[SEND_BATCH_DELAY]
+                if delay > 0:
+                    time.sleep(delay / 1000.0)
+
     def press_key(self, keyName):
         self.__enqueue(self.__pressKey, keyName)
         
-    def __pressKey(self, keyName):
-        self.__sendKeyPressEvent(self.__lookupKeyCode(keyName), 0)
+    def __pressKey(self, keyName, theWindow=None):
+        self.__sendKeyPressEvent(self.__lookupKeyCode(keyName), 0, theWindow)
 
     def release_key(self, keyName):
         self.__enqueue(self.__releaseKey, keyName)
         
-    def __releaseKey(self, keyName):
-        self.__sendKeyReleaseEvent(self.__lookupKeyCode(keyName), 0)
+    def __releaseKey(self, keyName, theWindow=None):
+        self.__sendKeyReleaseEvent(self.__lookupKeyCode(keyName), 0, theWindow)
 
     def __flushEvents(self):
+        newWindows = collections.OrderedDict() # window ID -> (window, time created)
         while True:
             try:
-                readable, w, e = select.select([self.localDisplay], [], [], 1)
-                time.sleep(1)
+                timeout = 1
+                if len(newWindows) > 0:
+                    firstCreated = newWindows.itervalues().next()[1]
+                    timeout = max(0, firstCreated + NEW_WINDOW_GRAB_DELAY - time.time())
+
+                readable, w, e = select.select([self.localDisplay], [], [], timeout)
                 if self.localDisplay in readable:
-                    createdWindows = []
-                    destroyedWindows = []
-                    
                     for x in xrange(self.localDisplay.pending_events()):
                         event = self.localDisplay.next_event()
+                        self.windowTable.handle_event(event, self.rootWindow)
                         if event.type == X.CreateNotify:
-                            createdWindows.append(event.window)
+                            newWindows[event.window.id] = (event.window, time.time())
                         if event.type == X.DestroyNotify:
-                            destroyedWindows.append(event.window)
-                            
-                    for window in createdWindows:
-                        if window not in destroyedWindows:
-                            self.__enqueue(self.__grabHotkeysForWindow, window)
+                            newWindows.pop(event.window.id, None)
+
+                now = time.time()
+                while len(newWindows) > 0:
+                    windowId, (window, created) = newWindows.iteritems().next()
+                    if now - created < NEW_WINDOW_GRAB_DELAY:
+                        break
+                    del newWindows[windowId]
+                    self.__enqueue(self.__grabHotkeysForWindow, window)
 
                 if self.shutdown:
                     break
@@ -801,16 +952,18 @@ class XInterfaceBase(threading.Thread):
                 pass
 
     def handle_keypress(self, keyCode):
-        self.__enqueue(self.__handleKeyPress, keyCode)
+        self.__enqueue(self.__handleKeyPress, keyCode, latency.now())
     
-    def __handleKeyPress(self, keyCode):
-        focus = self.localDisplay.get_input_focus().focus
+    def __handleKeyPress(self, keyCode, queuedAt):
+        start = latency.record_since(latency.EVENT_QUEUE, queuedAt)
 
         modifier = self.__decodeModifier(keyCode)
         if modifier is not None:
             self.mediator.handle_modifier_down(modifier)
         else:
-            self.mediator.handle_keypress(keyCode, self.get_window_title(focus), self.get_window_class(focus))
+            windowTitle, windowClass = self.focusTracker.get_focus_info()
+            latency.record_since(latency.FOCUS_LOOKUP, start)
+            self.mediator.handle_keypress(keyCode, windowTitle, windowClass, queuedAt)
 
     def handle_keyrelease(self, keyCode):
         self.__enqueue(self.__handleKeyrelease, keyCode)
@@ -824,6 +977,8 @@ class XInterfaceBase(threading.Thread):
         self.__enqueue(self.__handleMouseclick, button, x, y)
         
     def __handleMouseclick(self, button, x, y):        
+        # A click may move the focus without the active window changing (e.g. into a popup)
+        self.focusTracker.invalidate()
         title = self.get_window_title()
         klass = self.get_window_class()
         info = (title, klass)
@@ -844,11 +999,7 @@ class XInterfaceBase(threading.Thread):
         Checks if the given keyCode is a modifier key. If it is, returns the modifier name
         constant as defined in the iomediator module. If not, returns C{None}
         """
-        keyName = self.lookup_string(keyCode, False, False, False)
-        if keyName in MODIFIERS:
-            return keyName
-
-        return None
+        return self.__modifierKeys.get(keyCode)
 
     def __sendKeyCode(self, keyCode, modifiers=0, theWindow=None):
         if ConfigManager.SETTINGS[ENABLE_QT4_WORKAROUND] or self.__enableQT4Workaround:
@@ -857,9 +1008,7 @@ class XInterfaceBase(threading.Thread):
         self.__sendKeyReleaseEvent(keyCode, modifiers, theWindow)
 
     def __checkWorkaroundNeeded(self):
-        focus = self.localDisplay.get_input_focus().focus
-        windowName = self.get_window_title(focus)
-        windowClass = self.get_window_class(focus)
+        windowName, windowClass = self.focusTracker.get_focus_info()
         w = self.app.configManager.workAroundApps
 
         if w.match(windowName) or w.match(windowClass):
@@ -919,6 +1068,14 @@ class XInterfaceBase(threading.Thread):
         focus.send_event(keyEvent)
 
     def __lookupKeyCode(self, char):
+        try:
+            return self.__keyNameCache[char]
+        except KeyError:
+            keyCode = self.__lookupKeyCodeUncached(char)
+            self.__keyNameCache[char] = keyCode
+            return keyCode
+
+    def __lookupKeyCodeUncached(self, char):
         if char in AK_TO_XK_MAP:
             return self.localDisplay.keysym_to_keycode(AK_TO_XK_MAP[char])
         elif char.startswith("<code"):
@@ -930,6 +1087,10 @@ class XInterfaceBase(threading.Thread):
                 logger.error("Unknown key name: %s", char)
                 raise
 
+    def __lookupFocusInfo(self):
+        focus = self.localDisplay.get_input_focus().focus
+        return (self.get_window_title(focus), self.get_window_class(focus))
+
     def get_window_title(self, window=None, traverse=True):
         try:
             if window is None:
@@ -966,6 +1127,26 @@ class XInterfaceBase(threading.Thread):
         except:
             return ""
     
+    def get_window_list(self):
+        """
+        @return: a list of (title, class) tuples for all client windows, in the window manager's order
+        """
+        return self.windowTable.get_windows(self.localDisplay, self.rootWindow)
+        
+    def get_active_geometry(self):
+        """
+        @return: the (x, y, width, height) of the active window in root window coordinates, or
+        None if there is no active window
+        """
+        try:
+            window = self.windowTable.get_active_window(self.localDisplay, self.rootWindow)
+            geometry = window.get_geometry()
+            origin = self.rootWindow.translate_coords(window, 0, 0)
+            return (origin.x, origin.y, geometry.width, geometry.height)
+        except:
+            logger.debug("Unable to get active window geometry", exc_info=True)
+            return None
+    
     def __getWinClass(self, windowvar, traverse):
         wmclass = windowvar.get_wm_class()
 
@@ -980,6 +1161,7 @@ class XInterfaceBase(threading.Thread):
     def cancel(self):
         self.queue.put_nowait((None, None))
         self.shutdown = True
+        self.focusTracker.cancel()
         self.listenerThread.join()
         self.eventThread.join()
         self.localDisplay.flush()
@@ -987,6 +1169,270 @@ class XInterfaceBase(threading.Thread):
         self.join()
 
 
+class SpareKeycodePool:
+    """
+    Manages the spare keycodes used to send characters that are not on the keyboard map.
+
+    Each spare keycode provides two slots (unshifted and shifted). Characters keep their
+    slot between sends; when the pool is full, the least recently used character not
+    needed for the current send gives up its slot.
+    """
+
+    def __init__(self, keyCodes):
+        """
+        @param keyCodes: the keycodes with no keysyms mapped in the current keyboard mapping
+        """
+        self.keyCodes = frozenset(keyCodes)
+        self.free = [(keyCode, offset) for keyCode in keyCodes for offset in (0, 1)]
+        self.free.reverse()
+        self.assigned = collections.OrderedDict() # char -> slot, least recently used first
+        self.owners = {} # slot -> char
+
+    def get(self, char):
+        """
+        @return: the (keyCode, offset) slot assigned to the given character, or None
+        """
+        return self.assigned.get(char)
+
+    def assign(self, chars):
+        """
+        Make sure each of the given characters has a slot, and mark them as most recently used.
+
+        @return: the set of keycodes whose characters have changed and need remapping
+        """
+        changed = set()
+        wanted = set(chars)
+        for char in chars:
+            if char in self.assigned:
+                self.assigned[char] = self.assigned.pop(char)
+                continue
+
+            if len(self.free) > 0:
+                slot = self.free.pop()
+            else:
+                victim = None
+                for assignedChar in self.assigned:
+                    if assignedChar not in wanted:
+                        victim = assignedChar
+                        break
+                if victim is None:
+                    logger.warn("No spare keycodes left to send character %r", char)
+                    continue
+                slot = self.assigned.pop(victim)
+
+            self.assigned[char] = slot
+            self.owners[slot] = char
+            changed.add(slot[0])
+
+        return changed
+
+    def get_keysyms(self, keyCode):
+        """
+        @return: the (unshifted, shifted) keysyms currently assigned to the given keycode
+        """
+        return tuple(ord(self.owners[(keyCode, offset)]) if (keyCode, offset) in self.owners else 0
+                     for offset in (0, 1))
+
+
+class WindowTable:
+    """
+    The titles and classes of the client windows listed in the root window's _NET_CLIENT_LIST.
+
+    XInterfaceBase passes it the events from its event listener. Changes to the client list
+    mark the list for reloading, and title or class changes on a client window mark that
+    window for reloading. Each window's title and class are then read once per change,
+    instead of for every query.
+    """
+
+    def __init__(self, display, getTitle, getClass):
+        """
+        @param display: display used to intern the atoms
+        @param getTitle: callable returning the title of a window, given the window and traverse=False
+        @param getClass: callable returning the class of a window, given the window and traverse=False
+        """
+        self.getTitle = getTitle
+        self.getClass = getClass
+        self.lock = threading.Lock()
+        self.clientListAtom = display.intern_atom("_NET_CLIENT_LIST", True)
+        self.activeAtom = display.intern_atom("_NET_ACTIVE_WINDOW", True)
+        self.watchedAtoms = set([Xatom.WM_NAME, Xatom.WM_CLASS,
+                                 display.intern_atom("_NET_WM_NAME", True),
+                                 display.intern_atom("_NET_WM_VISIBLE_NAME", True)])
+        self.watchedAtoms.discard(X.NONE)
+        self.reset()
+
+    def reset(self):
+        """
+        Drop all cached windows, e.g. after the display connection has been replaced.
+        """
+        with self.lock:
+            self.windows = collections.OrderedDict() # window ID -> [window, title, class]
+            self.listDirty = True
+
+    def handle_event(self, event, rootWindow):
+        if event.type == X.PropertyNotify:
+            if event.window.id == rootWindow.id:
+                if event.atom == self.clientListAtom:
+                    self.listDirty = True
+            elif event.atom in self.watchedAtoms:
+                with self.lock:
+                    entry = self.windows.get(event.window.id)
+                    if entry is not None:
+                        entry[1] = None
+
+        elif event.type in (X.CreateNotify, X.DestroyNotify):
+            self.listDirty = True
+
+    def get_windows(self, display, rootWindow):
+        """
+        @return: a list of (title, class) tuples for all client windows
+        """
+        with self.lock:
+            if self.listDirty:
+                self.__readClientList(display, rootWindow)
+
+            for entry in self.windows.itervalues():
+                if entry[1] is None:
+                    entry[1] = self.getTitle(entry[0], False)
+                    entry[2] = self.getClass(entry[0], False)
+
+            return [(entry[1], entry[2]) for entry in self.windows.itervalues()]
+
+    def get_active_window(self, display, rootWindow):
+        """
+        @return: the window named by _NET_ACTIVE_WINDOW, or the window with input focus if
+        the window manager does not set it
+        """
+        if self.activeAtom != X.NONE:
+            active = rootWindow.get_full_property(self.activeAtom, X.AnyPropertyType)
+            if active is not None and len(active.value) > 0 and active.value[0] != X.NONE:
+                return display.create_resource_object("window", active.value[0])
+        return display.get_input_focus().focus
+
+    def __readClientList(self, display, rootWindow):
+        # Cleared before reading, so a change notified during the read is not lost
+        self.listDirty = False
+        clientList = None
+        if self.clientListAtom != X.NONE:
+            clientList = rootWindow.get_full_property(self.clientListAtom, X.AnyPropertyType)
+
+        old = self.windows
+        self.windows = collections.OrderedDict()
+        if clientList is None:
+            return
+
+        catch = error.CatchError(error.BadWindow)
+        for windowId in clientList.value:
+            entry = old.get(windowId)
+            if entry is None:
+                window = display.create_resource_object("window", windowId)
+                # Receive PropertyNotify for title and class changes
+                window.change_attributes(event_mask=X.PropertyChangeMask, onerror=catch)
+                entry = [window, None, None]
+            self.windows[windowId] = entry
+        display.flush()
+
+
+class FocusTracker(threading.Thread):
+    """
+    Keeps the title and class of the focused window in memory, so that keypress handling
+    does not need to query the X server for them on every key.
+
+    The cached value is dropped whenever _NET_ACTIVE_WINDOW changes on the root window, or
+    the title or class of the active window changes. Window managers that do not maintain
+    _NET_ACTIVE_WINDOW get no caching, and every lookup goes to the X server as before.
+    """
+
+    def __init__(self, lookup):
+        """
+        @param lookup: callable returning a (title, class) tuple for the window with input focus
+        """
+        threading.Thread.__init__(self, name="FocusTracker-thread")
+        self.setDaemon(True)
+        self.lookup = lookup
+        self.lock = threading.Lock()
+        self.info = None
+        self.generation = 0
+        self.shutdown = False
+        self.activeWindow = None
+
+        self.display = display.Display()
+        self.rootWindow = self.display.screen().root
+        self.activeAtom = self.display.intern_atom("_NET_ACTIVE_WINDOW", True)
+        self.watchedAtoms = set([Xatom.WM_NAME, Xatom.WM_CLASS,
+                                 self.display.intern_atom("_NET_WM_NAME", True),
+                                 self.display.intern_atom("_NET_WM_VISIBLE_NAME", True)])
+        self.watchedAtoms.discard(X.NONE)
+        self.enabled = self.activeAtom != X.NONE
+
+    def get_focus_info(self):
+        """
+        @return: a (title, class) tuple for the window with input focus
+        """
+        info = self.info
+        if info is not None:
+            return info
+
+        generation = self.generation
+        info = self.lookup()
+        with self.lock:
+            # Don't cache a value that may have been invalidated while it was being looked up
+            if self.enabled and generation == self.generation:
+                self.info = info
+        return info
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.info = None
+
+    def cancel(self):
+        self.shutdown = True
+        if self.isAlive():
+            self.join()
+        self.display.close()
+
+    def run(self):
+        if not self.enabled:
+            logger.info("Window manager does not set _NET_ACTIVE_WINDOW - focus window info will not be cached")
+            return
+
+        self.rootWindow.change_attributes(event_mask=X.PropertyChangeMask)
+        self.__watchActiveWindow()
+
+        while not self.shutdown:
+            try:
+                readable, w, e = select.select([self.display], [], [], 1)
+                if self.display in readable:
+                    for x in xrange(self.display.pending_events()):
+                        event = self.display.next_event()
+                        if event.type != X.PropertyNotify:
+                            continue
+                        if event.atom == self.activeAtom and event.window.id == self.rootWindow.id:
+                            self.__watchActiveWindow()
+                            self.invalidate()
+                        elif event.atom in self.watchedAtoms:
+                            self.invalidate()
+            except:
+                logger.exception("Error tracking the focused window")
+                self.invalidate()
+
+    def __watchActiveWindow(self):
+        """
+        Move the property change subscription from the previously active window to the current one.
+        """
+        catch = error.CatchError(error.BadWindow)
+        if self.activeWindow is not None:
+            self.activeWindow.change_attributes(event_mask=X.NoEventMask, onerror=catch)
+            self.activeWindow = None
+
+        active = self.rootWindow.get_full_property(self.activeAtom, X.AnyPropertyType)
+        if active is not None and len(active.value) > 0 and active.value[0] != X.NONE:
+            self.activeWindow = self.display.create_resource_object("window", active.value[0])
+            self.activeWindow.change_attributes(event_mask=X.PropertyChangeMask, onerror=catch)
+        self.display.flush()
+
+
 class XRecordInterface(XInterfaceBase):
 
     def initialise(self):
@@ -1035,6 +1481,7 @@ class XRecordInterface(XInterfaceBase):
             # not an event
             return
 
+        start = latency.now()
         data = reply.data
         while len(data):
             event, data = rq.EventField(None).parse_binary_value(data, self.recordDisplay.display, None, None)
@@ -1044,6 +1491,7 @@ class XRecordInterface(XInterfaceBase):
                 self.handle_keyrelease(event.detail)
             elif event.type == X.ButtonPress:
                 self.handle_mouseclick(event.detail, event.root_x, event.root_y)
+        latency.record_since(latency.RECORD, start)
 
 
 class AtSpiInterface(XInterfaceBase):
@@ -1077,7 +1525,7 @@ class AtSpiInterface(XInterfaceBase):
         pyatspi.Registry.pumpQueuedEvents()
         return True
 
-from iomediator import Key, MODIFIERS
+from iomediator import Key, MODIFIERS, SEND_TEXT, SEND_KEY
 from configmanager import *
 
 XK.load_keysym_group('xkb')
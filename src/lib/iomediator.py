@@ -90,13 +90,21 @@ class Key:
     def is_key(klass, keyString):
         # Key strings must be treated as case insensitive - always convert to lowercase
         # before doing any comparisons
-        return keyString.lower() in klass.__dict__.values() or keyString.startswith("<code")
+        if keyString[:1] != '<':
+            return False
+        return keyString.lower() in KEY_NAMES or KEY_CODE_RE.match(keyString) is not None
 
 import datetime, time, threading, Queue, re, logging
+import latency
 
 _logger = logging.getLogger("iomediator")
 
+# All named key tokens, plus raw keycodes written as <codeN>
+KEY_NAMES = frozenset(value for name, value in Key.__dict__.iteritems() if name.isupper())
+KEY_CODE_RE = re.compile(r"<code\d+>$")
+
 MODIFIERS = [Key.CONTROL, Key.ALT, Key.ALT_GR, Key.SHIFT, Key.SUPER, Key.HYPER, Key.META, Key.CAPSLOCK, Key.NUMLOCK]
+MODIFIER_NAMES = frozenset(MODIFIERS)
 HELD_MODIFIERS = [Key.CONTROL, Key.ALT, Key.SUPER, Key.SHIFT, Key.HYPER, Key.META]
 NAVIGATION_KEYS = [Key.LEFT, Key.RIGHT, Key.UP, Key.DOWN, Key.BACKSPACE, Key.HOME, Key.END, Key.PAGE_UP, Key.PAGE_DOWN]
 
@@ -104,6 +112,11 @@ NAVIGATION_KEYS = [Key.LEFT, Key.RIGHT, Key.UP, Key.DOWN, Key.BACKSPACE, Key.HOM
 KEY_SPLIT_RE = re.compile("(<[^<>]+>\+?)", re.UNICODE)
 SEND_LOCK = threading.Lock()
 
+# Operations produced by IoMediator.compile_string
+SEND_TEXT = 0
+SEND_KEY = 1
+SEND_MODIFIED_KEY = 2
+
 from interface import *
 from configmanager import *
 
@@ -150,7 +163,7 @@ class IoMediator(threading.Thread):
         
     def shutdown(self):
         self.interface.cancel()
-        self.queue.put_nowait((None, None, None))
+        self.queue.put_nowait((None, None, None, None, None))
         self.join()
 
     # Callback methods for Interfaces ----
@@ -181,28 +194,36 @@ class IoMediator(threading.Thread):
         if not modifier in (Key.CAPSLOCK, Key.NUMLOCK):
             self.modifiers[modifier] = False
     
-    def handle_keypress(self, keyCode, windowName, windowClass):
+    def handle_keypress(self, keyCode, windowName, windowClass, timestamp=None):
         """
         Looks up the character for the given key code, applying any 
         modifiers currently in effect, and passes it to the expansion service.
+        
+        @param timestamp: time at which the interface received the key, for latency tracking
         """
-        self.queue.put_nowait((keyCode, windowName, windowClass))
+        queuedAt = latency.now()
+        self.queue.put_nowait((keyCode, windowName, windowClass, timestamp or queuedAt, queuedAt))
         
     def run(self):
         while True:
-            keyCode, windowName, windowClass = self.queue.get()
+            keyCode, windowName, windowClass, receivedAt, queuedAt = self.queue.get()
             if keyCode is None and windowName is None:
                 break
             
+            start = latency.record_since(latency.MEDIATOR_QUEUE, queuedAt)
             numLock = self.modifiers[Key.NUMLOCK]
             modifiers = self.__getModifiersOn()
             shifted = self.modifiers[Key.CAPSLOCK] ^ self.modifiers[Key.SHIFT]
             key = self.interface.lookup_string(keyCode, shifted, numLock, self.modifiers[Key.ALT_GR])
             rawKey = self.interface.lookup_string(keyCode, False, False, False)
+            start = latency.record_since(latency.LOOKUP_STRING, start)
             
             for target in self.listeners:
                 target.handle_keypress(rawKey, modifiers, key, windowName, windowClass)                
                 
+            latency.record_since(latency.MATCH, start)
+            latency.record_since(latency.TOTAL, receivedAt)
+
             self.queue.task_done()
             
     def handle_mouse_click(self, rootX, rootY, relX, relY, button, windowInfo):
@@ -215,20 +236,25 @@ class IoMediator(threading.Thread):
         """
         Sends the given string for output.
         """
-        if len(string) == 0:
-            return
+        self.send_compiled(self.compile_string(string))
 
+    def compile_string(self, string):
+        """
+        Work out the interface calls needed to send the given string, so that text which
+        is sent repeatedly only needs parsing once.
+        
+        @return: a tuple of operations to pass to L{send_compiled}
+        """
+        ops = []
         k = Key()
         
         string = string.replace('\n', "<enter>")
         string = string.replace('\t', "<tab>")
         
-        _logger.debug("Send via event interface")
-        self.__clearModifiers()
         modifiers = []            
         for section in KEY_SPLIT_RE.split(string):
             if len(section) > 0:
-                if k.is_key(section[:-1]) and section[-1] == '+' and section[:-1] in MODIFIERS:
+                if section[-1] == '+' and section[:-1] in MODIFIER_NAMES:
                     # Section is a modifier application (modifier followed by '+')
                     modifiers.append(section[:-1])
                     
@@ -236,20 +262,32 @@ class IoMediator(threading.Thread):
                     if len(modifiers) > 0:
                         # Modifiers ready for application - send modified key
                         if k.is_key(section):
-                            self.interface.send_modified_key(section, modifiers)
+                            ops.append((SEND_MODIFIED_KEY, section, tuple(modifiers)))
                             modifiers = []
                         else:
-                            self.interface.send_modified_key(section[0], modifiers)
+                            ops.append((SEND_MODIFIED_KEY, section[0], tuple(modifiers)))
                             if len(section) > 1:
-                                self.interface.send_string(section[1:])
+                                ops.append((SEND_TEXT, section[1:]))
                             modifiers = []
                     else:
                         # Normal string/key operation                    
                         if k.is_key(section):
-                            self.interface.send_key(section)
+                            ops.append((SEND_KEY, section))
                         else:
-                            self.interface.send_string(section)
+                            ops.append((SEND_TEXT, section))
                             
+        return tuple(ops)
+        
+    def send_compiled(self, ops):
+        """
+        Sends output previously compiled using L{compile_string}.
+        """
+        if len(ops) == 0:
+            return
+
+        _logger.debug("Send via event interface")
+        self.__clearModifiers()
+        self.interface.send_compiled(ops)
         self.__reapplyModifiers()
         
     def paste_string(self, string, pasteCommand):
@@ -307,8 +345,7 @@ class IoMediator(threading.Thread):
         """
         Sends the given number of backspace key presses.
         """
-        for i in range(count):
-            self.interface.send_key(Key.BACKSPACE)
+        self.interface.send_repeated_key(Key.BACKSPACE, count)
         
     def send_mouse_click(self, x, y, button, relative):
         self.interface.send_mouse_click(x, y, button, relative)
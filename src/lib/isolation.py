@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Chris Dekter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runs scripts in pre-forked worker processes, so CPU heavy scripts do not compete for the
+GIL with the threads handling keyboard input.
+
+Names in a script's scope that must act on this process (keyboard, window, clipboard, store
+etc.) are replaced in the worker by proxies. Each method call on a proxy is sent back over
+the worker's pipe and run here, and the result is sent back to the worker.
+"""
+
+import multiprocessing, threading, traceback, logging
+
+_logger = logging.getLogger("isolation")
+
+DEFAULT_SHUTDOWN_TIMEOUT = 5.0
+
+# Messages from a worker
+CALL = "call"           # (objectName, methodName, args, kwargs)
+DONE = "done"           # None
+FAILED = "failed"       # formatted traceback
+
+# Replies to a worker's call
+RESULT = "result"
+ERROR = "error"
+
+
+class IsolatedScriptError(Exception):
+    """
+    Raised when an isolated script fails, or its worker process exits.
+    """
+    pass
+
+
+class ProxyCallError(Exception):
+    """
+    Raised in a worker when a proxied call fails in the main process.
+    """
+    pass
+
+
+class _Proxy:
+    """
+    Stands in for an object living in the main process. Only method calls are supported;
+    arguments and return values must be picklable.
+    """
+
+    def __init__(self, conn, name):
+        self.__conn = conn
+        self.__name = name
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+
+        def call(*args, **kwargs):
+            self.__conn.send((CALL, (self.__name, attr, args, kwargs)))
+            kind, value = self.__conn.recv()
+            if kind == ERROR:
+                raise ProxyCallError(value)
+            return value
+
+        return call
+
+
+def _worker_main(conn, localScope):
+    codeObjects = {}
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+
+        source, proxiedNames = request
+        scope = localScope.copy()
+        for name in proxiedNames:
+            scope[name] = _Proxy(conn, name)
+
+        try:
+            code = codeObjects.get(source)
+            if code is None:
+                code = codeObjects[source] = compile(source, "<string>", "exec")
+            exec code in scope
+            conn.send((DONE, None))
+        except Exception:
+            conn.send((FAILED, traceback.format_exc()))
+
+
+class _Claim:
+    """
+    A single run's hold on a worker process.
+    """
+
+    def __init__(self):
+        self.worker = None
+        self.stopped = False
+
+
+class _Worker:
+
+    def __init__(self, localScope):
+        self.conn, childConn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main, args=(childConn, localScope))
+        self.process.daemon = True
+        self.process.start()
+        childConn.close()
+
+    def stop(self, timeout):
+        try:
+            self.conn.send(None)
+        except (IOError, EOFError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class IsolatedScriptPool:
+    """
+    A fixed set of pre-forked worker processes for running isolated scripts.
+
+    Each run occupies one worker; further runs wait for a free one. A worker that dies
+    is not replaced, as forking this process once it has started threads is unsafe; the
+    pool shrinks instead, and runs fail once it has no workers left.
+    """
+
+    def __init__(self, workers, localScope):
+        """
+        @param workers: number of worker processes to start
+        @param localScope: names available to scripts that work in any process (e.g. system)
+        """
+        self.localScope = localScope
+        self.lock = threading.Condition()      # notified when a worker becomes idle or exits
+        self.idle = []
+        self.workers = []
+        self.shuttingDown = False
+
+        for i in xrange(max(1, workers)):
+            worker = _Worker(localScope)
+            self.workers.append(worker)
+            self.idle.append(worker)
+
+    def run(self, source, scope, onStart=None):
+        """
+        Run script source in a worker process, handling its calls to the objects in scope.
+        Blocks until the script has finished.
+
+        @param source: the script's source code
+        @param scope: the names the script would normally run with; everything not in the
+        pool's local scope is proxied to these objects
+        @param onStart: if given, called with a function that stops the script, by
+        terminating its worker process or by giving up waiting for one, and with None once
+        the script has finished and the function must no longer be used
+        @raise IsolatedScriptError: if the script raised an error or was stopped, or its
+        worker died
+        """
+        proxiedNames = [name for name in scope if name not in self.localScope and not name.startswith("__")]
+        claim = _Claim()
+        # The worker is only reused if the script ran to completion, otherwise it is dropped
+        alive = False
+        if onStart is not None:
+            onStart(lambda: self.__stop(claim))
+        try:
+            worker = self.__take(claim)
+            worker.conn.send((source, proxiedNames))
+            while True:
+                kind, value = worker.conn.recv()
+                if kind == CALL:
+                    self.__handleCall(worker.conn, scope, *value)
+                elif kind == DONE:
+                    alive = True
+                    return
+                else:
+                    alive = True
+                    raise IsolatedScriptError(value)
+
+        except (IOError, EOFError), e:
+            raise IsolatedScriptError("Script worker process exited: %s" % str(e))
+
+        finally:
+            try:
+                if onStart is not None:
+                    onStart(None)
+            finally:
+                if claim.worker is not None:
+                    # A stopped worker may be terminated even though its script finished
+                    self.__release(claim.worker, alive and not claim.stopped)
+
+    def shutdown(self, timeout=DEFAULT_SHUTDOWN_TIMEOUT):
+        with self.lock:
+            self.shuttingDown = True
+            workers = list(self.workers)
+            self.workers = []
+            self.lock.notifyAll()
+        for worker in workers:
+            worker.stop(timeout)
+
+    def __handleCall(self, conn, scope, name, attr, args, kwargs):
+        try:
+            result = getattr(scope[name], attr)(*args, **kwargs)
+        except Exception, e:
+            _logger.debug("Proxied call %s.%s failed", name, attr, exc_info=True)
+            conn.send((ERROR, "%s: %s" % (e.__class__.__name__, str(e))))
+            return
+
+        try:
+            conn.send((RESULT, result))
+        except Exception, e:
+            conn.send((ERROR, "Unable to return %s.%s result: %s" % (name, attr, str(e))))
+
+    def __take(self, claim):
+        with self.lock:
+            while True:
+                if self.shuttingDown:
+                    raise IsolatedScriptError("Script worker processes have been shut down")
+                if claim.stopped:
+                    raise IsolatedScriptError("Script stopped while waiting for a worker process")
+                if len(self.idle) > 0:
+                    claim.worker = self.idle.pop()
+                    return claim.worker
+                if len(self.workers) == 0:
+                    raise IsolatedScriptError("All script worker processes have exited")
+                self.lock.wait()
+
+    def __stop(self, claim):
+        with self.lock:
+            claim.stopped = True
+            if claim.worker is not None:
+                claim.worker.process.terminate()
+            else:
+                self.lock.notifyAll()
+
+    def __release(self, worker, alive):
+        with self.lock:
+            if self.shuttingDown:
+                return
+            if alive and worker.process.is_alive():
+                self.idle.append(worker)
+                self.lock.notifyAll()
+                return
+            self.workers.remove(worker)
+            left = len(self.workers)
+            # Waiting runs must fail rather than wait forever once no worker is left
+            self.lock.notifyAll()
+
+        _logger.warning("Script worker process %d exited - %d left", worker.process.pid, left)
+        worker.stop(0)
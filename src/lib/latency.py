@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Chris Dekter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Rolling latency histograms for each hop a keystroke takes on its way through AutoKey.
+"""
+
+import threading, collections, time
+
+# Stages, in the order a keystroke passes through them
+RECORD = "record"                   # XRecord callback: parse the reply and queue the events
+EVENT_QUEUE = "eventQueue"          # waiting in the XInterfaceBase event queue
+FOCUS_LOOKUP = "focusLookup"        # get_input_focus and window title/class lookups
+MEDIATOR_QUEUE = "mediatorQueue"    # waiting in the IoMediator queue
+LOOKUP_STRING = "lookupString"      # keycode to string conversion
+MATCH = "match"                     # Service.handle_keypress
+OUTPUT_QUEUE = "outputQueue"        # expansion waiting for the output lane
+SCRIPT_QUEUE = "scriptQueue"        # script waiting for a script worker
+TOTAL = "total"                     # event queued by the interface to end of handle_keypress
+
+STAGES = (RECORD, EVENT_QUEUE, FOCUS_LOOKUP, MEDIATOR_QUEUE, LOOKUP_STRING, MATCH,
+          OUTPUT_QUEUE, SCRIPT_QUEUE, TOTAL)
+
+# Upper bounds of the histogram buckets, in milliseconds
+BUCKET_BOUNDS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)
+
+WINDOW_SIZE = 1000
+
+now = time.time
+
+
+class RollingHistogram:
+    """
+    Latency statistics over the most recent samples of a single stage.
+    """
+
+    def __init__(self, windowSize=WINDOW_SIZE):
+        self.samples = collections.deque(maxlen=windowSize)
+        self.total = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds * 1000.0)
+        self.total += 1
+
+    def get_stats(self):
+        """
+        Get the statistics for the current window of samples. All times are in milliseconds.
+
+        @return: a dictionary with the sample count, mean, p50, p90, p99 and max, plus a
+        'le_<bound>' entry for each histogram bucket and 'total' for all samples ever added
+        """
+        samples = sorted(self.samples)
+        count = len(samples)
+        stats = {"count": float(count), "total": float(self.total)}
+        if count > 0:
+            stats["mean"] = sum(samples) / count
+            stats["p50"] = samples[int(count * 0.50)]
+            stats["p90"] = samples[min(count - 1, int(count * 0.90))]
+            stats["p99"] = samples[min(count - 1, int(count * 0.99))]
+            stats["max"] = samples[-1]
+        else:
+            for key in ("mean", "p50", "p90", "p99", "max"):
+                stats[key] = 0.0
+
+        index = 0
+        for bound in BUCKET_BOUNDS:
+            while index < count and samples[index] <= bound:
+                index += 1
+            stats["le_%g" % bound] = float(index)
+        stats["le_inf"] = float(count)
+        return stats
+
+
+class LatencyRecorder:
+    """
+    Collects a rolling histogram for each keystroke stage. Safe to use from any thread.
+    """
+
+    def __init__(self, windowSize=WINDOW_SIZE):
+        self.windowSize = windowSize
+        self.lock = threading.Lock()
+        self.reset()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.histograms[stage].add(seconds)
+
+    def record_since(self, stage, start):
+        """
+        Record the time elapsed since the given timestamp (as returned by now()).
+
+        @return: the current time, so consecutive stages can be chained
+        """
+        end = now()
+        self.record(stage, end - start)
+        return end
+
+    def get_stats(self):
+        """
+        @return: a dictionary mapping each stage with samples to its statistics
+        """
+        with self.lock:
+            return dict((stage, histogram.get_stats()) for stage, histogram in self.histograms.iteritems()
+                        if histogram.total > 0)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = collections.defaultdict(lambda: RollingHistogram(self.windowSize))
+
+
+# Shared recorder used by the interface, mediator, service and worker pools
+recorder = LatencyRecorder()
+
+record = recorder.record
+record_since = recorder.record_since
+get_stats = recorder.get_stats
+reset = recorder.reset
@@ -1,6 +1,11 @@
+import logging, time
 from iomediator import KEY_SPLIT_RE, Key
+from executor import TimeoutError
+from filecache import FileContentsCache
 import common
 
+_logger = logging.getLogger("macro")
+
 if common.USING_QT:
     from PyKDE4.kdecore import ki18n
     from PyKDE4.kdeui import KMenu, KAction
@@ -23,13 +28,40 @@ else:
 
 class MacroManager:
     
-    def __init__(self, engine):
+    def __init__(self, engine, pool=None, timeout=0):
+        """
+        @param engine: scripting engine used to run <script> macros
+        @param pool: if given, a WorkerPool on which to evaluate concurrent macros
+        @param timeout: maximum number of seconds to wait for a macro's concurrent tokens
+        (0 = no limit)
+        
+        The timeout only abandons the expansion. A token that is still running when it
+        expires keeps its pool worker until it returns, so a script that never returns
+        permanently takes one of the pool's workers.
+        """
         self.macros = []
+        self.macrosById = {}
+        self.pool = pool
+        self.timeout = timeout
+        
+        self.register(ScriptMacro(engine))
+        self.register(DateMacro())
+        self.register(FileContentsMacro())
+        self.register(CursorMacro())
         
-        self.macros.append(ScriptMacro(engine))
-        self.macros.append(DateMacro())
-        self.macros.append(FileContentsMacro())
-        self.macros.append(CursorMacro())
+    def register(self, macro):
+        """
+        Add a macro. Its tokens are found by ID in the same single pass as every other
+        macro's, so registering more macros does not add another scan of the expansion.
+        
+        Macros are run in the order they are registered, each over all of its own tokens.
+        A macro that depends on the final text (such as cursor positioning) must be
+        registered after the macros that produce it.
+        """
+        if macro.ID in self.macrosById:
+            self.macros.remove(self.macrosById[macro.ID])
+        self.macros.append(macro)
+        self.macrosById[macro.ID] = macro
         
     def get_menu(self, callback, menu=None):
         if common.USING_QT:
@@ -49,16 +81,86 @@ class MacroManager:
         return menu
         
     def process_expansion(self, expansion):
-        parts = KEY_SPLIT_RE.split(expansion.string)
+        parts, slots = self.find_macros(expansion.string)
+        if len(slots) > 0:
+            expansion.string = self.__process(list(parts), slots)
+        
+    def find_macros(self, string):
+        """
+        Split the string into parts and find those that are macro tokens.
+        
+        @return: a tuple of the parts and a tuple of the indexes of the macro tokens
+        """
+        parts = tuple(KEY_SPLIT_RE.split(string))
+        # The split pattern has a single group, so tokens are always at the odd indexes
+        slots = tuple(i for i in xrange(1, len(parts), 2) if get_macro_id(parts[i]) in self.macrosById)
+        return parts, slots
         
-        for macro in self.macros:        
-            macro.process(parts)
+    def process_plan(self, plan):
+        """
+        Run the macros in a compiled expansion plan, without re-splitting the string
+        or scanning the plain text.
         
-        expansion.string = ''.join(parts)
+        @return: the expanded string
+        @raise MacroError: if the macros did not finish within the timeout
+        """
+        if len(plan.macroSlots) == 0:
+            return plan.string
+        return self.__process(list(plan.parts), plan.macroSlots)
         
+    def __process(self, parts, slots):
+        # Dispatch each token to its macro, then run the macros in registration order
+        tokens = {}
+        for i in slots:
+            tokens.setdefault(get_macro_id(parts[i]), []).append(i)
+            
+        for macro in self.macros:
+            indexes = tokens.get(macro.ID, ())
+            if macro.CONCURRENT and self.pool is not None and len(indexes) > 0:
+                self.__evaluateConcurrently(macro, parts, indexes)
+            else:
+                for i in indexes:
+                    macro.do_process(parts, i)
+        
+        return ''.join(parts)
+        
+    def __evaluateConcurrently(self, macro, parts, indexes):
+        # Start every token, then splice the results back in their original positions
+        futures = [self.pool.submit_future(macro.evaluate, parts[i]) for i in indexes]
+        if self.timeout > 0:
+            deadline = time.time() + self.timeout
+        else:
+            deadline = None
+        
+        for i, future in zip(indexes, futures):
+            try:
+                if deadline is None:
+                    parts[i] = future.result()
+                else:
+                    parts[i] = future.result(max(0, deadline - time.time()))
+            except TimeoutError:
+                raise MacroError("Macro %s timed out after %gs" % (parts[i], self.timeout))
+        
+
+class MacroError(Exception):
+    """
+    Raised when a phrase's macros cannot be evaluated, so its expansion must not be sent.
+    """
+    pass
+
+
+def get_macro_id(token):
+    """
+    @return: the macro ID named by a token, e.g. 'date' for '<date format=%Y>'
+    """
+    return token[1:-1].split(' ', 1)[0]
+
 
 class AbstractMacro:
 
+    # Whether tokens can be evaluated concurrently on the manager's pool, using evaluate()
+    CONCURRENT = False
+
     def get_token(self):
         ret = "<%s" % self.ID
         
@@ -73,12 +175,6 @@ class AbstractMacro:
         
         return ret
             
-    def _can_process(self, token):
-        if KEY_SPLIT_RE.match(token):
-            return token[1:-1].split(' ', 1)[0] == self.ID
-        else:
-            return False
-        
     def _get_args(self, token):
         l = token[:-1].split(' ')
         ret = {}
@@ -93,11 +189,6 @@ class AbstractMacro:
                 raise Exception("Missing mandatory argument '%s' for macro '%s'" % (k, self.ID))
         
         return ret
-        
-    def process(self, parts):
-        for i in xrange(len(parts)):
-            if self._can_process(parts[i]):
-                self.do_process(parts, i)
     
 
 class CursorMacro(AbstractMacro):
@@ -122,13 +213,22 @@ class ScriptMacro(AbstractMacro):
     ARGS = [("name", _("Name")),
             ("args", _("Arguments (comma separated)"))]
     
+    CONCURRENT = True
+    
     def __init__(self, engine):
         self.engine = engine
+        
+    def evaluate(self, token):
+        """
+        Run the script named by the token and return its value. Safe to call from
+        several threads at once, as the engine keeps macro state per thread.
+        """
+        args = self._get_args(token)
+        self.engine.run_script_from_macro(args)
+        return self.engine.get_return_value()
     
     def do_process(self, parts, i):
-        args = self._get_args(parts[i])
-        self.engine.run_script_from_macro(args)
-        parts[i] = self.engine.get_return_value()
+        parts[i] = self.evaluate(parts[i])
 
 
 class DateMacro(AbstractMacro):
@@ -149,9 +249,9 @@ class FileContentsMacro(AbstractMacro):
     TITLE = _("Insert file contents")
     ARGS = [("name", _("File name"))]
     
+    def __init__(self):
+        self.cache = FileContentsCache()
+    
     def do_process(self, parts, i):
         name = self._get_args(parts[i])["name"]
-        
-        with open(name, "r") as inputFile:
-            parts[i] = inputFile.read()
-    
+        parts[i] = self.cache.read(name)
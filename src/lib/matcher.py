@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Chris Dekter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging, collections
+
+_logger = logging.getLogger("matcher")
+
+WINDOW_SCOPE_CACHE_SIZE = 32
+
+
+class _Automaton:
+    """
+    Aho-Corasick automaton over a set of abbreviations. States are plain integers,
+    with 0 being the root (empty input) state.
+    """
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.entries = [[]]
+        self.dictLink = [0]
+
+    def insert(self, abbr, entry):
+        state = 0
+        for char in abbr:
+            nextState = self.goto[state].get(char)
+            if nextState is None:
+                nextState = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.entries.append([])
+                self.dictLink.append(0)
+                self.goto[state][char] = nextState
+            state = nextState
+
+        self.entries[state].append(entry)
+
+    def build(self):
+        """
+        Compute the failure and dictionary links, breadth first from the root.
+        """
+        goto, fail, entries, dictLink = self.goto, self.fail, self.entries, self.dictLink
+        queue = collections.deque(goto[0].itervalues())
+
+        while queue:
+            state = queue.popleft()
+            for char, child in goto[state].iteritems():
+                queue.append(child)
+                f = fail[state]
+                while f != 0 and char not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(char, 0)
+
+                # Link to the longest proper suffix state that completes an abbreviation
+                if len(entries[fail[child]]) > 0:
+                    dictLink[child] = fail[child]
+                else:
+                    dictLink[child] = dictLink[fail[child]]
+
+    def step(self, state, char):
+        goto = self.goto
+        while True:
+            nextState = goto[state].get(char)
+            if nextState is not None:
+                return nextState
+            if state == 0:
+                return 0
+            state = self.fail[state]
+
+    def collect(self, state, found):
+        """
+        Add every entry for abbreviations ending at the given state to found.
+        """
+        while state != 0:
+            for ordinal, target in self.entries[state]:
+                found[ordinal] = target
+            state = self.dictLink[state]
+
+
+class AbbreviationIndex:
+    """
+    Aho-Corasick automaton over the abbreviations of all folders and items.
+
+    Used by the service to find the few folders/items that could possibly be triggered
+    by the end of the input buffer, instead of checking every abbreviation in the
+    configuration on each keypress. The candidates returned are a superset of the real
+    matches - the caller must still confirm each one's abbreviation and window filter.
+    
+    Matcher states are tuples of (exact, folded) automaton states, starting from L{ROOT}.
+    """
+    
+    ROOT = (0, 0)
+
+    def __init__(self, folders=[], items=[]):
+        """
+        @param folders: folders with abbreviation trigger mode enabled
+        @param items: phrases/scripts with abbreviation trigger mode enabled
+        """
+        self.__exact = _Automaton()
+        self.__folded = _Automaton()
+        self.__folderCount = len(folders)
+        ordinal = 0
+
+        for target in folders + items:
+            # Abbreviations for ignoreCase targets are matched against the lowercased
+            # buffer, so they live in a separate automaton that is fed folded chars
+            if target.ignoreCase:
+                automaton = self.__folded
+            else:
+                automaton = self.__exact
+
+            for abbr in target.abbreviations:
+                if len(abbr) > 0:
+                    automaton.insert(abbr, (ordinal, target))
+
+            ordinal += 1
+
+        self.__exact.build()
+        self.__folded.build()
+        _logger.debug("Built abbreviation index for %d folders, %d items", len(folders), len(items))
+
+    def advance(self, state, char):
+        """
+        Get the matcher state after the given character is typed in the given state.
+        """
+        return (self.__exact.step(state[0], char), self.__folded.step(state[1], char.lower()))
+
+    def get_matches(self, states):
+        """
+        Get the folders and items having an abbreviation that ends at any of the given
+        states.
+
+        @return: a tuple of (folders, items), each in configuration order
+        """
+        found = {}
+        for exactState, foldedState in states:
+            self.__exact.collect(exactState, found)
+            self.__folded.collect(foldedState, found)
+
+        folders = []
+        items = []
+        for ordinal in sorted(found):
+            if ordinal < self.__folderCount:
+                folders.append(found[ordinal])
+            else:
+                items.append(found[ordinal])
+
+        return (folders, items)
+
+    def get_candidates(self, buffer):
+        """
+        Find the folders and items having an abbreviation that ends either at the last
+        character of the buffer (immediate expansion) or just before it (expansion on
+        a trigger character).
+
+        This scans the whole buffer; during normal typing use an L{AbbreviationMatcher}
+        to avoid doing so on every keypress.
+
+        @param buffer: the current input buffer
+        @return: a tuple of (folders, items), each in configuration order
+        """
+        previous = state = self.ROOT
+        for char in buffer:
+            previous = state
+            state = self.advance(state, char)
+
+        return self.get_matches((state, previous))
+
+
+class AbbreviationMatcher:
+    """
+    Streaming abbreviation matcher for the service's input stack.
+
+    Keeps the automaton state reached after each character of the input stack, so a
+    keypress only advances the automaton by one character, and backspace simply drops
+    the last state. The states are replayed from the input stack when the configuration
+    (and hence the index) changes.
+    """
+
+    def __init__(self, maxLength):
+        self.index = None
+        self.states = collections.deque(maxlen=maxLength)
+
+    def set_index(self, index, inputStack):
+        """
+        Start matching against the given index, if not already doing so.
+
+        @param index: the current L{AbbreviationIndex}
+        @param inputStack: the characters typed so far
+        """
+        if index is not self.index:
+            self.index = index
+            self.states.clear()
+            state = AbbreviationIndex.ROOT
+            for char in inputStack:
+                state = index.advance(state, char)
+                self.states.append(state)
+
+    def append(self, char):
+        if len(self.states) > 0:
+            state = self.states[-1]
+        else:
+            state = AbbreviationIndex.ROOT
+        self.states.append(self.index.advance(state, char))
+
+    def backspace(self):
+        if len(self.states) > 0:
+            self.states.pop()
+
+    def clear(self):
+        self.states.clear()
+
+    def get_candidates(self):
+        """
+        Get the folders and items that could be triggered by the current input stack.
+
+        @return: a tuple of (folders, items), each in configuration order
+        """
+        count = len(self.states)
+        if count == 0:
+            return ([], [])
+        elif count == 1:
+            return self.index.get_matches((self.states[-1], AbbreviationIndex.ROOT))
+        else:
+            return self.index.get_matches((self.states[-1], self.states[-2]))
+
+
+class HotkeyIndex:
+    """
+    Hash index of the configured hotkeys, keyed by (modifiers, key).
+
+    Lets the service find the hotkeys bound to a key combination with a single lookup,
+    so that only those few candidates need their window filter evaluated.
+    """
+
+    EMPTY = ((), (), ())
+
+    def __init__(self, globalHotkeys=[], hotkeys=[], hotkeyFolders=[]):
+        """
+        @param globalHotkeys: global application hotkeys
+        @param hotkeys: phrases/scripts with hotkey trigger mode enabled
+        @param hotkeyFolders: folders with hotkey trigger mode enabled
+        """
+        table = {}
+        for slot, targets in enumerate((globalHotkeys, hotkeys, hotkeyFolders)):
+            for target in targets:
+                if target.hotKey is not None:
+                    key = (tuple(target.modifiers), target.hotKey)
+                    if key not in table:
+                        table[key] = ([], [], [])
+                    table[key][slot].append(target)
+
+        self.__table = table
+
+    def get_candidates(self, modifiers, key):
+        """
+        Get the hotkeys bound to the given key combination.
+
+        @param modifiers: sorted list of modifiers held down
+        @param key: the raw (unshifted) key pressed
+        @return: a tuple of (global hotkeys, items, folders), each in configuration order
+        """
+        return self.__table.get((tuple(modifiers), key), self.EMPTY)
+
+
+class WindowScope:
+    """
+    The folders/items whose window filter excludes a particular window.
+    """
+
+    def __init__(self, excluded):
+        self.excluded = excluded
+
+    def allows(self, target):
+        return target not in self.excluded
+
+    def filter(self, targets):
+        """
+        @return: the given targets that may be triggered in this window, in the same order
+        """
+        if len(self.excluded) == 0:
+            return targets
+        return [target for target in targets if target not in self.excluded]
+
+
+class WindowFilterIndex:
+    """
+    Groups the folders/items that have a window filter by their applicable regex, and
+    computes the L{WindowScope} for a window once, caching it for the most recently
+    focused windows.
+
+    Each distinct regex is evaluated once per new window instead of once per item on
+    every keypress, and switching back and forth between windows hits the cache.
+    """
+
+    def __init__(self, targets=[], cacheSize=WINDOW_SCOPE_CACHE_SIZE):
+        """
+        @param targets: folders/items with an abbreviation or hotkey trigger
+        @param cacheSize: number of recent windows to keep scopes for
+        """
+        groups = {}
+        for target in targets:
+            regex = target.get_applicable_regex()
+            if regex is not None:
+                if regex.pattern not in groups:
+                    groups[regex.pattern] = (regex, set())
+                groups[regex.pattern][1].add(target)
+
+        self.__groups = groups.values()
+        self.__cacheSize = cacheSize
+        self.__cache = collections.OrderedDict()
+        self.__emptyScope = WindowScope(frozenset())
+
+    def get_scope(self, windowInfo):
+        """
+        Get the scope for the window with the given (title, class).
+        """
+        if len(self.__groups) == 0:
+            return self.__emptyScope
+
+        scope = self.__cache.pop(windowInfo, None)
+        if scope is None:
+            scope = self.__buildScope(windowInfo)
+            if len(self.__cache) >= self.__cacheSize:
+                self.__cache.popitem(last=False)
+
+        self.__cache[windowInfo] = scope
+        return scope
+
+    def __buildScope(self, windowInfo):
+        _logger.debug("Computing window scope for %r", windowInfo)
+        title, klass = windowInfo
+        excluded = set()
+        for regex, targets in self.__groups:
+            if not (regex.match(title) or regex.match(klass)):
+                excluded.update(targets)
+
+        return WindowScope(frozenset(excluded))
+
+
+class InputBuffer:
+    """
+    Fixed-capacity buffer holding the most recently typed characters.
+
+    Once full, appending a character silently drops the oldest one. The contents and a
+    lowercased copy are kept as strings and updated as each character is typed, so
+    abbreviation checks can call C{endswith()} on them directly.
+
+    Each keypress copies the buffer, but at its small fixed size that costs about the
+    same as updating a ring buffer's slots, and a ring's C{endswith()} would have to
+    compare characters in Python (see test/inputbufferbenchmark.py).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.text = u''
+        self.folded = u''
+
+    def append(self, char):
+        if len(self.text) < self.capacity:
+            self.text += char
+            self.folded += char.lower()
+        else:
+            self.text = self.text[1:] + char
+            self.folded = self.folded[1:] + char.lower()
+
+    def pop(self):
+        """
+        Remove and return the most recently typed character.
+        """
+        if not self.text:
+            raise IndexError("pop from empty input buffer")
+        char = self.text[-1]
+        self.text = self.text[:-1]
+        self.folded = self.folded[:-1]
+        return char
+
+    def clear(self):
+        self.text = u''
+        self.folded = u''
+
+    def endswith(self, suffix, start=0, end=None):
+        return self.text.endswith(suffix, start, end)
+
+    def lower(self):
+        """
+        Get the buffer contents with each character lowercased.
+        """
+        return self.folded
+
+    def get_string(self):
+        return self.text
+
+    def __len__(self):
+        return len(self.text)
+
+    def __getitem__(self, index):
+        return self.text[index]
+
+    def __iter__(self):
+        return iter(self.text)
+
+    def __repr__(self):
+        return repr(self.text)
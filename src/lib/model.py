@@ -19,6 +19,7 @@ import re, os, os.path, glob, logging
 from configmanager import *
 from iomediator import Key, NAVIGATION_KEYS, KEY_SPLIT_RE
 from scripting import Store
+from scheduler import RetriggerPolicy
 
 _logger = logging.getLogger("model")
 
@@ -27,6 +28,9 @@ DEFAULT_WORDCHAR_REGEX = '[\w]'
 JSON_FILE_PATTERN = "%s/.%s.json"
 SPACES_RE = re.compile(r"^ | $")
 
+# Number of expansion plans kept per phrase (one per distinct trigger suffix/case variant)
+MAX_CACHED_PLANS = 8
+
 def make_wordchar_re(wordChars):
     return "[^%s]" % wordChars
 
@@ -136,6 +140,16 @@ class AbstractAbbreviation:
         
         return False
         
+    def check_abbreviation(self, buffer):
+        """
+        Check only whether one of the abbreviations has been typed at the end of the
+        buffer, for callers that already know the item has abbreviations enabled and is
+        allowed in the current window (see L{check_input} for the full check).
+        
+        @param buffer: the input buffer to check
+        """
+        return self._should_trigger_abbreviation(buffer)
+        
     def _get_trigger_abbreviation(self, buffer):
         for abbr in self.abbreviations:
             if self.__checkInput(buffer, abbr):
@@ -144,41 +158,55 @@ class AbstractAbbreviation:
         return None      
         
     def __checkInput(self, buffer, abbr):
-        stringBefore, typedAbbr, stringAfter = self._partition_input(buffer, abbr)
+        """
+        Only the end of the buffer is examined, so the buffer may be either a string or
+        an InputBuffer.
+        """
+        if len(abbr) == 0:
+            return False
         
-        if len(typedAbbr) > 0:            
-            # Check trigger character condition
-            if not self.immediate:
-                # If not immediate expansion, check last character
-                if len(stringAfter) == 1:
-                    # Have a character after abbr
-                    if self.wordChars.match(stringAfter):
-                        # last character(s) is a word char, can't send expansion
-                        return False
-                    elif len(stringAfter) > 1:
-                        # Abbr not at/near end of buffer any more, can't send
-                        return False
-                else:
-                    # Nothing after abbr yet, can't expand yet
+        if self.ignoreCase:
+            buffer = buffer.lower()
+        
+        bufferLen = len(buffer)
+        
+        # The abbr can only trigger if it is at the end of the buffer, or followed by
+        # a single character. In either case that is also its last occurrence.
+        if buffer.endswith(abbr):
+            afterLen = 0
+        elif buffer.endswith(abbr, 0, bufferLen - 1):
+            afterLen = 1
+        else:
+            # Abbr not typed, or not at/near end of buffer any more, can't send
+            return False
+        
+        # Check trigger character condition
+        if not self.immediate:
+            # If not immediate expansion, check last character
+            if afterLen == 1:
+                # Have a character after abbr
+                if self.wordChars.match(buffer[-1]):
+                    # last character is a word char, can't send expansion
                     return False
-            
             else:
-                # immediate option enabled, check abbr is at end of buffer
-                if len(stringAfter) > 0:
-                    return False
-                
-            # Check chars ahead of abbr
-            # length of stringBefore should always be > 0
-            if len(stringBefore) > 0:
-                if self.wordChars.match(stringBefore[-1]):
-                    # last char before is a word char
-                    if not self.triggerInside:
-                        # can't trigger when inside a word
-                        return False
+                # Nothing after abbr yet, can't expand yet
+                return False
+        
+        else:
+            # immediate option enabled, check abbr is at end of buffer
+            if afterLen > 0:
+                return False
             
-            return True
+        # Check chars ahead of abbr
+        abbrStart = bufferLen - afterLen - len(abbr)
+        if abbrStart > 0:
+            if self.wordChars.match(buffer[abbrStart - 1]):
+                # last char before is a word char
+                if not self.triggerInside:
+                    # can't trigger when inside a word
+                    return False
         
-        return False
+        return True
     
     def _partition_input(self, currentString, abbr):
         """
@@ -613,6 +641,8 @@ class Phrase(AbstractAbbreviation, AbstractHotkey, AbstractWindowFilter):
         self.showInTrayMenu = False
         self.sendMode = SendMode.KEYBOARD
         self.path = path
+        self.__plans = {}
+        self.__planSource = None
 
     def build_path(self, baseName=None):        
         if baseName is None:
@@ -784,6 +814,30 @@ class Phrase(AbstractAbbreviation, AbstractHotkey, AbstractWindowFilter):
         #self.__parsePositionTokens(expansion)
         return expansion
     
+    def get_expansion_plan(self, string, compiler):
+        """
+        Get the compiled plan for sending an expansion of this phrase.
+        
+        Plans are cached per expanded string, since the same phrase text is normally followed
+        by the same few trigger characters. The cache is dropped whenever the phrase text is
+        changed, whether by editing or reloading.
+        
+        @param string: the expansion string, as returned by L{build_phrase}
+        @param compiler: callable that compiles a string into an L{ExpansionPlan}
+        """
+        if self.__planSource != self.phrase:
+            self.__plans = {}
+            self.__planSource = self.phrase
+        
+        try:
+            return self.__plans[string]
+        except KeyError:
+            plan = compiler(string)
+            if len(self.__plans) >= MAX_CACHED_PLANS:
+                self.__plans.clear()
+            self.__plans[string] = plan
+            return plan
+    
     def calculate_input(self, buffer):
         """
         Calculate how many keystrokes were used in triggering this phrase.
@@ -872,6 +926,20 @@ class Phrase(AbstractAbbreviation, AbstractHotkey, AbstractWindowFilter):
     def __repr__(self):
         return "Phrase('" + self.description + "')"
 
+class ExpansionPlan:
+    """
+    An expansion string compiled for sending. Holds the string split into parts, the indexes of
+    any parts that are macro tokens, and for strings without macros, the operations needed to
+    send it via the keyboard (as compiled by IoMediator.compile_string).
+    """
+    
+    def __init__(self, string, parts, macroSlots, sendOps=None):
+        self.string = string
+        self.parts = parts
+        self.macroSlots = macroSlots
+        self.sendOps = sendOps
+        
+
 class Expansion:
     
     def __init__(self, string):
@@ -897,7 +965,13 @@ class Script(AbstractAbbreviation, AbstractHotkey, AbstractWindowFilter):
         self.omitTrigger = False
         self.parent = None
         self.showInTrayMenu = False
+        self.isolated = False
+        self.timeout = None         # None = use the global script timeout
+        self.maxRunning = 0
+        self.retrigger = RetriggerPolicy.QUEUE
         self.path = path
+        self.__codeObject = None
+        self.__codeSource = None
         
     def build_path(self, baseName=None):        
         if baseName is None:
@@ -931,12 +1005,28 @@ class Script(AbstractAbbreviation, AbstractHotkey, AbstractWindowFilter):
             "prompt": self.prompt,
             "omitTrigger": self.omitTrigger,
             "showInTrayMenu": self.showInTrayMenu,
+            "isolated": self.isolated,
+            "timeout": self.timeout,
+            "maxRunning": self.maxRunning,
+            "retrigger": self.retrigger,
             "abbreviation": AbstractAbbreviation.get_serializable(self),
             "hotkey": AbstractHotkey.get_serializable(self),
             "filter": AbstractWindowFilter.get_serializable(self)
             }
         return d
 
+    def get_code_object(self, compiler):
+        """
+        Get the compiled code of this script, compiling it again only when the code has
+        been changed, whether by editing or reloading.
+        
+        @param compiler: callable that compiles source code into a code object
+        """
+        if self.__codeSource != self.code:
+            self.__codeObject = compiler(self.code)
+            self.__codeSource = self.code
+        return self.__codeObject
+
     def load(self, parent):
         self.parent = parent
         
@@ -965,6 +1055,10 @@ class Script(AbstractAbbreviation, AbstractHotkey, AbstractWindowFilter):
         self.prompt = data["prompt"]
         self.omitTrigger = data["omitTrigger"]
         self.showInTrayMenu = data["showInTrayMenu"]
+        self.isolated = data.get("isolated", False)
+        self.timeout = data.get("timeout")
+        self.maxRunning = data.get("maxRunning", 0)
+        self.retrigger = data.get("retrigger", RetriggerPolicy.QUEUE)
         AbstractAbbreviation.load_from_serialized(self, data["abbreviation"])
         AbstractHotkey.load_from_serialized(self, data["hotkey"])
         AbstractWindowFilter.load_from_serialized(self, data["filter"])
@@ -994,6 +1088,10 @@ class Script(AbstractAbbreviation, AbstractHotkey, AbstractWindowFilter):
         self.omitTrigger = theScript.omitTrigger
         self.parent = theScript.parent
         self.showInTrayMenu = theScript.showInTrayMenu
+        self.isolated = theScript.isolated
+        self.timeout = theScript.timeout
+        self.maxRunning = theScript.maxRunning
+        self.retrigger = theScript.retrigger
         self.copy_abbreviation(theScript)
         self.copy_hotkey(theScript)
         self.copy_window_filter(theScript)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 Chris Dekter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading, collections, itertools, logging, time
+
+_logger = logging.getLogger("scheduler")
+
+
+class RetriggerPolicy:
+    """
+    Enumeration class for what to do when a script is triggered while it is already
+    running as many times as it is allowed to.
+
+    DROP: Ignore the new trigger
+    QUEUE: Run the script again once a running instance has finished
+    RESTART: Cancel the running instances and start again
+    """
+    DROP = "drop"
+    QUEUE = "queue"
+    RESTART = "restart"
+
+
+class ScriptCancelled(Exception):
+    """
+    Raised inside a script's thread when the script is cancelled or times out.
+    """
+    pass
+
+
+# The job being run by each scheduler thread
+_current = threading.local()
+
+def check_cancelled():
+    """
+    Raise ScriptCancelled if the job running in this thread has been cancelled. Does
+    nothing outside of a job.
+
+    Cancellation is cooperative: a script is only stopped at one of these checks, or by
+    its job's canceller. Raising the exception anywhere else could leave a lock held.
+    """
+    job = getattr(_current, "job", None)
+    if job is not None and job.is_cancelled():
+        raise ScriptCancelled(job.cancelReason)
+
+
+class CheckedObject:
+    """
+    Wraps an object given to scripts, so that each method call on it first checks
+    whether the calling script has been cancelled.
+    """
+
+    def __init__(self, target):
+        self.__target = target
+
+    def __getattr__(self, attr):
+        value = getattr(self.__target, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            check_cancelled()
+            return value(*args, **kwargs)
+
+        return call
+
+
+class ScriptJob:
+    """
+    A single scheduled run of a script.
+    """
+
+    def __init__(self, jobId, key, description, func, args, timeout, lock):
+        self.lock = lock            # the scheduler's lock, held while cancelling
+        self.id = jobId
+        self.key = key
+        self.description = description
+        self.func = func
+        self.args = args
+        self.timeout = timeout
+        self.queuedAt = time.time()
+        self.startedAt = None
+        self.canceller = None
+        self.cancelReason = None
+        self.finished = False
+
+    def is_cancelled(self):
+        return self.cancelReason is not None
+
+    def set_canceller(self, canceller):
+        """
+        Set a callable that stops the job without waiting for its next cancellation
+        check, e.g. by terminating a worker process. It is called with the scheduler's
+        lock held, straight away if the job has already been cancelled.
+
+        Passing None withdraws the callable once it must not be used any more, e.g.
+        because the worker process is about to be reused.
+        """
+        with self.lock:
+            self.canceller = canceller
+            if canceller is not None and self.is_cancelled():
+                canceller()
+
+
+class ScriptScheduler:
+    """
+    Runs scripts on a WorkerPool, enforcing a per-script limit on concurrent runs, a
+    wall-clock timeout and a re-trigger policy. Running scripts can be listed and cancelled.
+
+    The total number of scripts running at once is limited by the pool's worker count.
+    A cancelled job still counts towards its script's limit until it has actually stopped.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()           # job ID -> ScriptJob
+        self.waiting = collections.defaultdict(collections.deque)    # key -> queued ScriptJobs
+        self.nextId = itertools.count(1)
+
+    def submit(self, key, description, func, args=(), maxRunning=0, policy=RetriggerPolicy.QUEUE,
+               timeout=None, defaultTimeout=0):
+        """
+        Schedule a call to func(job, *args).
+
+        @param key: identifies the script, for counting its concurrent runs
+        @param description: name of the script, for listing and log messages
+        @param maxRunning: maximum concurrent runs of this script (0 = unlimited)
+        @param policy: a L{RetriggerPolicy} value, applied once maxRunning is reached
+        @param timeout: seconds after which the run is cancelled (0 = no timeout,
+        None = use defaultTimeout)
+        @param defaultTimeout: timeout used when the script does not set its own
+        @return: the scheduled job, or None if the trigger was dropped
+        """
+        if timeout is None:
+            timeout = defaultTimeout
+
+        with self.lock:
+            job = ScriptJob(self.nextId.next(), key, description, func, args, timeout, self.lock)
+            running = [j for j in self.jobs.itervalues() if j.key == key]
+
+            if maxRunning > 0 and len(running) >= maxRunning:
+                if policy == RetriggerPolicy.DROP:
+                    _logger.info("Script '%s' already running - ignoring trigger", description)
+                    return None
+                elif policy == RetriggerPolicy.QUEUE:
+                    _logger.debug("Script '%s' already running - queueing trigger", description)
+                    self.waiting[key].append(job)
+                    return job
+                else:
+                    # Start once a cancelled run has stopped, in place of any earlier restart
+                    _logger.info("Script '%s' already running - restarting", description)
+                    for j in running:
+                        self.__cancel(j, "restarted")
+                    self.waiting[key].clear()
+                    self.waiting[key].append(job)
+                    return job
+
+            self.__start(job)
+            return job
+
+    def cancel(self, jobId, reason="cancelled"):
+        """
+        Cancel a running or queued job. A running script stops at its next scripting API
+        call; one that is not calling the API runs on until it finishes.
+
+        @return: True if a job with the given ID was found
+        """
+        with self.lock:
+            job = self.jobs.get(jobId)
+            if job is not None:
+                self.__cancel(job, reason)
+                return True
+
+            for queue in self.waiting.itervalues():
+                for job in queue:
+                    if job.id == jobId:
+                        queue.remove(job)
+                        return True
+        return False
+
+    def list_jobs(self):
+        """
+        @return: a list of (job ID, description, state, seconds) tuples for all running and
+        queued jobs, where seconds is the time since the job started or was queued
+        """
+        now = time.time()
+        ret = []
+        with self.lock:
+            for job in self.jobs.itervalues():
+                if job.startedAt is None:
+                    ret.append((job.id, job.description, "starting", now - job.queuedAt))
+                elif job.is_cancelled():
+                    ret.append((job.id, job.description, "stopping", now - job.startedAt))
+                else:
+                    ret.append((job.id, job.description, "running", now - job.startedAt))
+            for queue in self.waiting.itervalues():
+                for job in queue:
+                    ret.append((job.id, job.description, "queued", now - job.queuedAt))
+        return ret
+
+    def __start(self, job):
+        self.jobs[job.id] = job
+        if not self.pool.submit(self.__run, job):
+            del self.jobs[job.id]
+
+    def __cancel(self, job, reason):
+        if job.finished or job.is_cancelled():
+            return
+        job.cancelReason = reason
+        _logger.warning("Cancelling script '%s': %s", job.description, reason)
+
+        if job.canceller is not None:
+            job.canceller()
+
+    def __run(self, job):
+        with self.lock:
+            if job.is_cancelled():
+                self.__finish(job)
+                return
+            job.startedAt = time.time()
+
+        timer = None
+        if job.timeout > 0:
+            timer = threading.Timer(job.timeout, self.cancel, (job.id, "timed out after %gs" % job.timeout))
+            timer.setDaemon(True)
+            timer.start()
+
+        _current.job = job
+        try:
+            job.func(job, *job.args)
+        except ScriptCancelled:
+            _logger.info("Script '%s' stopped: %s", job.description, job.cancelReason)
+        finally:
+            _current.job = None
+            if timer is not None:
+                timer.cancel()
+            with self.lock:
+                self.__finish(job)
+
+    def __finish(self, job):
+        job.finished = True
+        self.jobs.pop(job.id, None)
+        queue = self.waiting.get(job.key)
+        if queue:
+            self.__start(queue.popleft())
+        if not queue:
+            self.waiting.pop(job.key, None)
@@ -17,6 +17,8 @@
 
 import subprocess, threading, time, re
 import common, model, iomediator
+from command import RunningCommand, CommandTimeoutError
+from macro import MacroError
 if common.USING_QT:
     from PyQt4.QtGui import QClipboard, QApplication
 else:
@@ -450,11 +452,11 @@ class System:
     Simplified access to some system commands.
     """    
     
-    def exec_command(self, command, getOutput=True):
+    def exec_command(self, command, getOutput=True, timeout=None):
         """
         Execute a shell command
         
-        Usage: C{system.exec_command(command, getOutput=True)}
+        Usage: C{system.exec_command(command, getOutput=True, timeout=None)}
 
         Set getOutput to False if the command does not exit and return immediately. Otherwise
         AutoKey will not respond to any hotkeys/abbreviations etc until the process started
@@ -462,18 +464,42 @@ class System:
         
         @param command: command to be executed (including any arguments) - e.g. "ls -l"
         @param getOutput: whether to capture the (stdout) output of the command
+        @param timeout: maximum number of seconds to wait for the command, after which it is killed
         @raise subprocess.CalledProcessError: if the command returns a non-zero exit code
+        @raise CommandTimeoutError: if the command did not finish within the timeout
         """
         if getOutput:
-            p = subprocess.Popen(command, shell=True, bufsize=-1, stdout=subprocess.PIPE)
-            retCode = p.wait()
-            output = p.stdout.read()[:-1]
-            if retCode != 0:
-                raise subprocess.CalledProcessError(retCode, output)
-            else:
-                return output
+            return RunningCommand(command, timeout).result()
         else:
             subprocess.Popen(command, shell=True, bufsize=-1)
+            
+    def stream_command(self, command, timeout=None):
+        """
+        Execute a shell command, iterating over the lines of its output as they are produced
+        
+        Usage: C{for line in system.stream_command(command, timeout=None): ...}
+        
+        @param command: command to be executed (including any arguments) - e.g. "ls -l"
+        @param timeout: maximum number of seconds to wait for the command, after which it is killed
+        @raise subprocess.CalledProcessError: once the output ends, if the command returned a non-zero exit code
+        @raise CommandTimeoutError: if the command did not finish within the timeout
+        """
+        return RunningCommand(command, timeout).lines()
+        
+    def exec_command_async(self, command, timeout=None):
+        """
+        Start a shell command without waiting for it to finish
+        
+        Usage: C{cmd = system.exec_command_async(command, timeout=None)}
+        
+        Call C{cmd.result()} to wait for and get its output, or iterate over C{cmd.lines()}.
+        Several commands can be started before waiting for any of them.
+        
+        @param command: command to be executed (including any arguments) - e.g. "ls -l"
+        @param timeout: maximum number of seconds the command may run, after which it is killed
+        @return: a L{RunningCommand} for the command
+        """
+        return RunningCommand(command, timeout)
     
     def create_file(self, fileName, contents=""):
         """
@@ -858,7 +884,8 @@ class GtkClipboard:
         
 class Window:
     """
-    Basic window management using wmctrl
+    Basic window management. Window queries are answered directly from X; actions on
+    windows use wmctrl.
     
     Note: in all cases where a window title is required (with the exception of wait_for_focus()), 
     two special values of window title are permitted:
@@ -913,9 +940,8 @@ class Window:
         regex = re.compile(title)
         waited = 0
         while waited <= timeOut:
-            retCode, output = self.__runWmctrl(["-l"])
-            for line in output.split('\n'):
-                if regex.match(line[14:].split(' ', 1)[-1]):
+            for windowTitle, windowClass in self.mediator.interface.get_window_list():
+                if regex.match(windowTitle):
                     return True
                     
             if timeOut == 0:
@@ -1042,18 +1068,7 @@ class Window:
         @return: a 4-tuple containing the x-origin, y-origin, width and height of the window (in pixels)
         @rtype: C{tuple(int, int, int, int)}
         """
-        active = self.mediator.interface.get_window_title()
-        result, output = self.__runWmctrl(["-l", "-G"])
-        matchingLine = None
-        for line in output.split('\n'):
-            if active in line[34:].split(' ', 1)[-1]:
-                matchingLine = line
-                
-        if matchingLine is not None:
-            output = matchingLine.split()[2:6]
-            return map(int, output)
-        else:
-            return None
+        return self.mediator.interface.get_active_geometry()
 
     def get_active_title(self):
         """
@@ -1097,7 +1112,8 @@ class Engine:
         self.configManager = configManager
         self.runner = runner
         self.monitor = configManager.app.monitor
-        self.__returnValue = ''
+        # Macro arguments and return values are per thread, as phrase macros can run concurrently
+        self.__macroState = threading.local()
         
     def get_folder(self, title):
         """
@@ -1220,13 +1236,16 @@ class Engine:
     def run_script_from_macro(self, args):
         """
         Used internally by AutoKey for phrase macros
+        
+        @raise MacroError: if the script is missing or fails, so the phrase is not expanded
         """
-        self.__macroArgs = args["args"].split(',')
+        self.__macroState.args = args["args"].split(',')
+        self.__macroState.returnValue = ''
         
         try:
             self.run_script(args["name"])
         except Exception, e:
-            self.set_return_value("{ERROR: %s}" % str(e))
+            raise MacroError("Script '%s' failed: %s" % (args["name"], str(e)))
             
     def get_macro_arguments(self):
         """
@@ -1237,7 +1256,7 @@ class Engine:
         @return: the arguments
         @rtype: C{list(str())}
         """
-        return self.__macroArgs
+        return getattr(self.__macroState, "args", [])
             
     def set_return_value(self, val):
         """
@@ -1247,14 +1266,14 @@ class Engine:
         
         @param val: value to be stored
         """
-        self.__returnValue = val
+        self.__macroState.returnValue = val
         
     def get_return_value(self):
         """
         Used internally by AutoKey for phrase macros
         """
-        ret = self.__returnValue
-        self.__returnValue = ''
+        ret = getattr(self.__macroState, "returnValue", '')
+        self.__macroState.returnValue = ''
         return ret
 
 
@@ -16,7 +16,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import time, logging, threading, traceback
+import os, subprocess, time, logging, threading, traceback
 import common
 from iomediator import Key, IoMediator
 from configmanager import *
@@ -25,24 +25,26 @@ if common.USING_QT:
     from PyKDE4.kdecore import i18n
 else:
     from gtkui.popupmenu import *
-from macro import MacroManager
-import scripting, model
+from macro import MacroManager, MacroError
+import scripting, model, latency
+from matcher import AbbreviationMatcher, InputBuffer
+from executor import WorkerPool
+from codecache import CodeCache
+from isolation import IsolatedScriptPool
+from scheduler import ScriptScheduler, CheckedObject
 
 logger = logging.getLogger("service")
 
 MAX_STACK_LENGTH = 150
 
-def threaded(f):
-    
-    def wrapper(*args):
-        t = threading.Thread(target=f, args=args, name="Phrase-thread")
-        t.setDaemon(False)
-        t.start()
-        
-    wrapper.__name__ = f.__name__
-    wrapper.__dict__ = f.__dict__
-    wrapper.__doc__ = f.__doc__
-    return wrapper
+# Seconds to wait after an item is chosen from a popup menu, for the window the menu
+# was shown over to be active again
+MENU_CLOSE_DELAY = 0.25
+
+# Scripts used to run in this module's globals, so these were available without an
+# import. Existing scripts rely on them; new scripts should import what they use
+SCRIPT_IMPLICIT_NAMES = {"os": os, "subprocess": subprocess, "time": time,
+                         "threading": threading, "Key": Key}
 
 def synchronized(lock):
     """ Synchronization decorator. """
@@ -70,17 +72,32 @@ class Service:
         ConfigManager.SETTINGS[SERVICE_RUNNING] = False
         self.mediator = None
         self.app = app
-        self.inputStack = []
+        self.inputStack = InputBuffer(MAX_STACK_LENGTH)
+        self.matcher = AbbreviationMatcher(MAX_STACK_LENGTH)
         self.lastStackState = ''
         self.lastMenu = None
         
+        # Worker processes for isolated scripts are forked first, before this process
+        # starts any threads of its own
+        self.isolatedPool = None
+        if ConfigManager.SETTINGS[ISOLATED_SCRIPT_WORKERS] > 0:
+            self.isolatedPool = IsolatedScriptPool(ConfigManager.SETTINGS[ISOLATED_SCRIPT_WORKERS],
+                                                   ScriptRunner.get_isolated_scope())
+        
+        # Keyboard output goes through a single lane so expansions never interleave,
+        # while scripts get a small pool of their own. Script macros in phrases use a
+        # separate pool, so an expansion never waits behind a long running script
+        self.outputLane = WorkerPool("Output", 1, latency.OUTPUT_QUEUE)
+        self.scriptPool = WorkerPool("Script", ConfigManager.SETTINGS[SCRIPT_WORKERS], latency.SCRIPT_QUEUE)
+        self.macroPool = WorkerPool("Macro", ConfigManager.SETTINGS[SCRIPT_WORKERS])
+        
     def start(self):
         self.mediator = IoMediator(self)
         self.mediator.interface.initialise()
         self.mediator.interface.start()
         self.mediator.start()
         ConfigManager.SETTINGS[SERVICE_RUNNING] = True
-        self.scriptRunner = ScriptRunner(self.mediator, self.app)
+        self.scriptRunner = ScriptRunner(self.mediator, self.app, self.scriptPool, self.isolatedPool)
         self.phraseRunner = PhraseRunner(self)
         scripting.Store.GLOBALS = ConfigManager.SETTINGS[SCRIPT_GLOBALS]
         logger.info("Service now marked as running")
@@ -99,11 +116,15 @@ class Service:
     def shutdown(self, save=True):
         logger.info("Service shutting down")
         if self.mediator is not None: self.mediator.shutdown()
+        self.outputLane.shutdown()
+        self.scriptPool.shutdown()
+        self.macroPool.shutdown()
+        if self.isolatedPool is not None: self.isolatedPool.shutdown()
         if save: save_config(self.configManager)
             
     def handle_mouseclick(self, rootX, rootY, relX, relY, button, windowTitle):
         logger.debug("Received mouse click - resetting buffer")        
-        self.inputStack = []
+        self.__clearStack()
         
         # If we had a menu and receive a mouse click, means we already
         # hid the menu. Don't need to do it again
@@ -115,19 +136,28 @@ class Service:
     def handle_keypress(self, rawKey, modifiers, key, windowName, windowClass):
         logger.debug("Raw key: %r, modifiers: %r, Key: %s", rawKey, modifiers, key.encode("utf-8"))
         logger.debug("Window visible title: %r, Window class: %r" % (windowName, windowClass))
-        self.configManager.lock.acquire()
+        # Work from one consistent snapshot of the configuration for the whole keypress,
+        # even if it is reloaded part way through
+        config = self.configManager.snapshot
         windowInfo = (windowName, windowClass)
         
+        # Only hotkeys bound to this exact key combination need checking
+        globalHotkeys, hotKeys, hotKeyFolders = config.hotkeyIndex.get_candidates(modifiers, rawKey)
+        
         # Always check global hotkeys
-        for hotkey in self.configManager.globalHotkeys:
+        for hotkey in globalHotkeys:
             hotkey.check_hotkey(modifiers, rawKey, windowInfo)
         
         if self.__shouldProcess(windowInfo):
             itemMatch = None
             menu = None
+            
+            # Folders/items whose window filter doesn't match are excluded from the scope.
+            # The hotkey index has already matched the modifiers and key.
+            scope = config.windowFilterIndex.get_scope(windowInfo)
 
-            for item in self.configManager.hotKeys:
-                if item.check_hotkey(modifiers, rawKey, windowInfo):
+            for item in hotKeys:
+                if scope.allows(item):
                     itemMatch = item
                     break
 
@@ -141,8 +171,8 @@ class Service:
                     
             else:
                 logger.debug("No phrase/script matched hotkey")
-                for folder in self.configManager.hotKeyFolders:
-                    if folder.check_hotkey(modifiers, rawKey, windowInfo):
+                for folder in hotKeyFolders:
+                    if scope.allows(folder):
                         #menu = PopupMenu(self, [folder], [])
                         menu = ([folder], [])
 
@@ -158,7 +188,6 @@ class Service:
                 self.app.show_popup_menu(*menu)
             
             if itemMatch is not None:
-                self.__tryReleaseLock()
                 self.__processItem(itemMatch)
                 
                 
@@ -167,24 +196,24 @@ class Service:
             modifierCount = len(modifiers)
             
             if modifierCount > 1 or (modifierCount == 1 and Key.SHIFT not in modifiers):
-                self.inputStack = []
-                self.__tryReleaseLock()
+                self.__clearStack()
                 return
                 
             ### --- end of processing if non-printing modifiers are on --- ###
         
+            self.matcher.set_index(config.abbreviationIndex, self.inputStack)
             if self.__updateStack(key):
-                currentInput = ''.join(self.inputStack)
-                item, menu = self.__checkTextMatches([], self.configManager.abbreviations,
-                                                    currentInput, windowInfo, True)
+                # Only folders/items with an abbreviation ending at the end of the buffer
+                # can possibly match, so just check those
+                folders, items = self.matcher.get_candidates()
+                folders = scope.filter(folders)
+                items = scope.filter(items)
+                item, menu = self.__checkTextMatches([], items, self.inputStack, True)
                 if not item or menu:
-                    item, menu = self.__checkTextMatches(self.configManager.allFolders,
-                                                         self.configManager.allItems,
-                                                         currentInput, windowInfo)
+                    item, menu = self.__checkTextMatches(folders, items, self.inputStack)
                                                          
                 if item:
-                    self.__tryReleaseLock()
-                    self.__processItem(item, currentInput)
+                    self.__processItem(item, self.lastStackState)
                 elif menu:
                     if self.lastMenu is not None:
                         #self.lastMenu.remove_from_desktop()
@@ -194,14 +223,6 @@ class Service:
                     self.app.show_popup_menu(*menu)
                 
                 logger.debug("Input stack at end of handle_keypress: %s", self.inputStack)
-    
-        self.__tryReleaseLock()
-    
-    def __tryReleaseLock(self):     
-        try:     
-            self.configManager.lock.release()
-        except:
-            logger.debug("Ignored locking error in handle_keypress")
             
     def run_folder(self, name):
         folder = None
@@ -230,9 +251,20 @@ class Service:
                 
         raise Exception("No %s found with name '%s'" % (typeDescription, name))
                 
-    @threaded
+    def get_executor_stats(self):
+        """
+        @return: queue and task counters for the output lane and the script pool
+        """
+        return {"output": self.outputLane.get_stats(), "script": self.scriptPool.get_stats()}
+        
     def item_selected(self, item):
-        time.sleep(0.25) # wait for window to be active
+        # Wait for the window to be active again, without holding up the output lane;
+        # the item's own output is then queued on the lane as usual
+        timer = threading.Timer(MENU_CLOSE_DELAY, self.__itemSelected, (item,))
+        timer.setDaemon(True)
+        timer.start()
+        
+    def __itemSelected(self, item):
         self.lastMenu = None # if an item has been selected, the menu has been hidden
         self.__processItem(item, self.lastStackState)
         
@@ -242,7 +274,7 @@ class Service:
         """
         extraBs = len(self.inputStack) - len(buffer)
         if extraBs > 0:
-            extraKeys = ''.join(self.inputStack[len(buffer)])
+            extraKeys = self.inputStack[len(buffer)]
         else:
             extraBs = 0
             extraKeys = ''
@@ -273,27 +305,36 @@ class Service:
                 self.phraseRunner.undo_expansion()
             else:
                 # handle backspace by dropping the last saved character
-                self.inputStack = self.inputStack[:-1]
+                if len(self.inputStack) > 0:
+                    self.inputStack.pop()
+                self.matcher.backspace()
             
             return False
             
         elif len(key) > 1:
             # non-simple key
-            self.inputStack = []
+            self.__clearStack()
             self.phraseRunner.clear_last()
             return False
         else:
             # Key is a character
             self.phraseRunner.clear_last()
+            # the oldest character drops off once MAX_STACK_LENGTH is reached
             self.inputStack.append(key)
-            if len(self.inputStack) > MAX_STACK_LENGTH:
-                self.inputStack.pop(0)
+            self.matcher.append(key)
             return True
             
-    def __checkTextMatches(self, folders, items, buffer, windowInfo, immediate=False):
+    def __clearStack(self):
+        self.inputStack.clear()
+        self.matcher.clear()
+            
+    def __checkTextMatches(self, folders, items, buffer, immediate=False):
         """
         Check for an abbreviation/predictive match among the given folder and items 
-        (scripts, phrases).
+        (scripts, phrases) at the end of the given input buffer.
+        
+        The folders and items must already be known to have abbreviations enabled and
+        to be allowed in the current window, so only the abbreviation itself is checked.
         
         @return: a tuple possibly containing an item to execute, or a menu to show
         """
@@ -301,23 +342,24 @@ class Service:
         folderMatches = []
         
         for item in items:
-            if item.check_input(buffer, windowInfo):
+            if item.check_abbreviation(buffer):
                 if not item.prompt and immediate:
+                    self.lastStackState = buffer.get_string()
                     return (item, None)
                 else:
                     itemMatches.append(item)
                     
         for folder in folders:
-            if folder.check_input(buffer, windowInfo):
+            if folder.check_abbreviation(buffer):
                 folderMatches.append(folder)
                 break # There should never be more than one folder match anyway
         
         if self.__menuRequired(folderMatches, itemMatches, buffer):
-            self.lastStackState = buffer
+            self.lastStackState = buffer.get_string()
             #return (None, PopupMenu(self, folderMatches, itemMatches))
             return (None, (folderMatches, itemMatches))
         elif len(itemMatches) == 1:
-            self.lastStackState = buffer
+            self.lastStackState = buffer.get_string()
             return (itemMatches[0], None)
         else:
             return (None, None)
@@ -330,7 +372,7 @@ class Service:
         return windowInfo[0] != "Set Abbreviations" and self.is_running()
     
     def __processItem(self, item, buffer=''):
-        self.inputStack = []
+        self.__clearStack()
         self.lastStackState = ''
         
         if isinstance(item, model.Phrase):
@@ -369,31 +411,55 @@ class PhraseRunner:
     
     def __init__(self, service):
         self.service = service
-        self.macroManager = MacroManager(service.scriptRunner.engine)
+        self.macroManager = MacroManager(service.scriptRunner.engine, service.macroPool,
+                                         ConfigManager.SETTINGS[MACRO_TIMEOUT])
         self.lastExpansion = None
         self.lastPhrase = None  
         self.lastBuffer = None
 
-    @threaded
-    #@synchronized(iomediator.SEND_LOCK)
     def execute(self, phrase, buffer=''):
+        self.service.outputLane.submit(self.__execute, phrase, buffer)
+        
+    #@synchronized(iomediator.SEND_LOCK)
+    def __execute(self, phrase, buffer):
         mediator = self.service.mediator
         mediator.interface.begin_send()
-        
-        expansion = phrase.build_phrase(buffer)
-        self.macroManager.process_expansion(expansion)
-        
-        mediator.send_backspace(expansion.backspaces)
-        if phrase.sendMode == model.SendMode.KEYBOARD:
-            mediator.send_string(expansion.string)
-        else:
-            mediator.paste_string(expansion.string, phrase.sendMode)
-        mediator.interface.finish_send()
+        try:
+            expansion = phrase.build_phrase(buffer)
+            plan = phrase.get_expansion_plan(expansion.string, self.__compilePlan)
+            expansion.string = self.macroManager.process_plan(plan)
+            
+            mediator.send_backspace(expansion.backspaces)
+            if phrase.sendMode == model.SendMode.KEYBOARD:
+                if plan.sendOps is not None:
+                    mediator.send_compiled(plan.sendOps)
+                else:
+                    mediator.send_string(expansion.string)
+            else:
+                mediator.paste_string(expansion.string, phrase.sendMode)
+        except MacroError, e:
+            logger.warning("Expansion of phrase '%s' abandoned: %s", phrase.description, str(e))
+            if common.USING_QT:
+                self.service.app.notify_error(i18n("The phrase '%1' was not expanded: %2", phrase.description, str(e)))
+            else:
+                self.service.app.notify_error(_("The phrase '%s' was not expanded: %s") % (phrase.description, str(e)))
+            return
+        finally:
+            # Always release the send lock, or no other phrase or script could type again
+            mediator.interface.finish_send()
 
         self.lastExpansion = expansion
         self.lastPhrase = phrase
         self.lastBuffer = buffer
         
+    def __compilePlan(self, string):
+        parts, macroSlots = self.macroManager.find_macros(string)
+        sendOps = None
+        if len(macroSlots) == 0:
+            # Without macros the output never changes, so can be compiled up front
+            sendOps = self.service.mediator.compile_string(string)
+        return model.ExpansionPlan(string, parts, macroSlots, sendOps)
+        
     def can_undo(self):
         if self.lastExpansion is not None:
             return model.TriggerMode.ABBREVIATION in self.lastPhrase.modes
@@ -420,16 +486,24 @@ class PhraseRunner:
     
 class ScriptRunner:
     
-    def __init__(self, mediator, app):
+    def __init__(self, mediator, app, pool, isolatedPool=None):
         self.mediator = mediator
         self.app = app
+        self.pool = pool
+        self.isolatedPool = isolatedPool
+        self.scheduler = ScriptScheduler(pool)
         self.error = ''
-        self.scope = globals()
+        self.engine = scripting.Engine(app.configManager, self)
+        # Scripts see only the scripting API and SCRIPT_IMPLICIT_NAMES, not the internals
+        # of this module. Each run gets its own copy of this small namespace, plus the
+        # script's store
+        self.scope = {"__builtins__": __builtins__, "__name__": __name__}
+        self.scope.update(SCRIPT_IMPLICIT_NAMES)
         self.scope["keyboard"]= scripting.Keyboard(mediator)
         self.scope["mouse"]= scripting.Mouse(mediator)
         self.scope["system"] = scripting.System()
         self.scope["window"] = scripting.Window(mediator)
-        self.scope["engine"] = scripting.Engine(app.configManager, self)
+        self.scope["engine"] = self.engine
 
         if common.USING_QT:
             self.scope["dialog"] = scripting.QtDialog()
@@ -438,34 +512,87 @@ class ScriptRunner:
             self.scope["dialog"] = scripting.GtkDialog()
             self.scope["clipboard"] = scripting.GtkClipboard(app)
 
-        self.engine = self.scope["engine"]
+        # A cancelled script is stopped at its next call to one of these
+        for name in ("keyboard", "mouse", "system", "window", "engine", "dialog", "clipboard"):
+            self.scope[name] = CheckedObject(self.scope[name])
+        
+        # Compiled scripts persist across restarts; drop those no script uses any more
+        self.codeCache = CodeCache(CONFIG_CODE_CACHE_FOLDER)
+        self.codeCache.prune([item.code for item in app.configManager.allItems
+                              if isinstance(item, model.Script)])
     
-    @threaded
     def execute(self, script, buffer=''):
+        self.scheduler.submit(script, script.description, self.__execute, (script, buffer),
+                              script.maxRunning, script.retrigger, script.timeout,
+                              ConfigManager.SETTINGS[SCRIPT_TIMEOUT])
+        
+    def list_running(self):
+        """
+        @return: a list of (job ID, description, state, seconds) tuples for running and queued scripts
+        """
+        return self.scheduler.list_jobs()
+        
+    def cancel(self, jobId):
+        """
+        Cancel a running or queued script.
+        
+        @return: True if the script was found
+        """
+        return self.scheduler.cancel(jobId)
+        
+    def __execute(self, job, script, buffer):
         logger.debug("Script runner executing: %r", script)
 
-        scope = self.scope.copy()
-        scope["store"] = script.store
+        scope = self.__newScope(script)
         
         backspaces, stringAfter = script.process_buffer(buffer)
         self.mediator.send_backspace(backspaces)
 
         try:
-            exec script.code in scope
+            if script.isolated and self.isolatedPool is not None:
+                self.isolatedPool.run(script.code, scope, job.set_canceller)
+            else:
+                if script.isolated:
+                    logger.debug("No isolated script workers configured - running '%s' in-process", script.description)
+                exec script.get_code_object(self.codeCache.get) in scope
         except Exception, e:
-            logger.exception("Script error")
-            
-            if common.USING_QT:
+            if job.is_cancelled():
+                logger.warning("Script '%s' stopped: %s", script.description, job.cancelReason)
+                
+                if common.USING_QT:
+                    self.app.notify_error(i18n("The script '%1' was stopped: %2", script.description, job.cancelReason))
+                else:
+                    self.app.notify_error(_("The script '%s' was stopped: %s") % (script.description, job.cancelReason))
+                    
+            elif common.USING_QT:
+                logger.exception("Script error")
                 self.error = i18n("Script name: '%1'\n%2", script.description, traceback.format_exc())
                 self.app.notify_error(i18n("The script '%1' encountered an error", script.description))
                 
             else:
+                logger.exception("Script error")
                 self.error = _("Script name: '%s'\n%s") % (script.description, traceback.format_exc())
                 self.app.notify_error(_("The script '%s' encountered an error") % script.description)
             
         self.mediator.send_string(stringAfter)
         
+    @staticmethod
+    def get_isolated_scope():
+        """
+        @return: the part of the script scope that works the same in a worker process;
+        all other names are proxied back to this process
+        """
+        scope = {"__builtins__": __builtins__, "__name__": __name__, "system": scripting.System()}
+        scope.update(SCRIPT_IMPLICIT_NAMES)
+        return scope
+        
     def run_subscript(self, script):
+        # Always in-process: an isolated script calling engine.run_script() is already
+        # holding a worker, and the call is handled on this side of its pipe
+        scope = self.__newScope(script)
+        exec script.get_code_object(self.codeCache.get) in scope
+        
+    def __newScope(self, script):
         scope = self.scope.copy()
         scope["store"] = script.store
-        exec script.code in scope
+        return scope
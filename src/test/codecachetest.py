@@ -0,0 +1,58 @@
+import os, shutil, tempfile, unittest
+
+from lib.codecache import *
+
+class CodeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.directory, "codecache")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testCompilesOnce(self):
+        cache = CodeCache(self.cacheDir)
+        code = cache.get(u"x = 1 + 1")
+        self.assertTrue(cache.get(u"x = 1 + 1") is code)
+
+        scope = {}
+        exec code in scope
+        self.assertEqual(scope["x"], 2)
+
+    def testPersistsAcrossInstances(self):
+        CodeCache(self.cacheDir).get(u"y = 'persisted'")
+        self.assertEqual(len(os.listdir(self.cacheDir)), 1)
+
+        scope = {}
+        exec CodeCache(self.cacheDir).get(u"y = 'persisted'") in scope
+        self.assertEqual(scope["y"], "persisted")
+
+    def testChangedSourceRecompiles(self):
+        cache = CodeCache(self.cacheDir)
+        scope = {}
+        exec cache.get(u"z = 1") in scope
+        exec cache.get(u"z = 2") in scope
+        self.assertEqual(scope["z"], 2)
+
+    def testUnreadableFileIgnored(self):
+        cache = CodeCache(self.cacheDir)
+        cache.get(u"a = 1")
+        path = os.path.join(self.cacheDir, cache.get_key(u"a = 1") + CODE_FILE_EXTENSION)
+        with open(path, "wb") as outFile:
+            outFile.write("garbage")
+
+        scope = {}
+        exec CodeCache(self.cacheDir).get(u"a = 1") in scope
+        self.assertEqual(scope["a"], 1)
+
+    def testSyntaxError(self):
+        cache = CodeCache(self.cacheDir)
+        self.assertRaises(SyntaxError, cache.get, u"def (")
+
+    def testPrune(self):
+        cache = CodeCache(self.cacheDir)
+        cache.get(u"keep = 1")
+        cache.get(u"stale = 1")
+        cache.prune([u"keep = 1"])
+        self.assertEqual(os.listdir(self.cacheDir), [cache.get_key(u"keep = 1") + CODE_FILE_EXTENSION])
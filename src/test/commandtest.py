@@ -0,0 +1,107 @@
+import subprocess, time, unittest
+
+from lib.command import *
+from lib.executor import WorkerPool
+from lib.scheduler import ScriptScheduler, ScriptCancelled
+
+def is_running(pid):
+    try:
+        with open("/proc/%d/stat" % pid) as statFile:
+            state = statFile.read().rsplit(")", 1)[1].split()[0]
+    except IOError:
+        return False
+    return state not in ("Z", "X")
+
+class RunningCommandTest(unittest.TestCase):
+
+    def testResult(self):
+        self.assertEqual(RunningCommand("seq 3").result(), "1\n2\n3")
+
+    def testLinesInOrder(self):
+        self.assertEqual(list(RunningCommand("seq 2000").lines()), [str(i) for i in range(1, 2001)])
+
+    def testLinesStreamed(self):
+        lines = RunningCommand("echo first; sleep 5; echo second", timeout=10).lines()
+        start = time.time()
+        self.assertEqual(lines.next(), "first")
+        self.assertTrue(time.time() - start < 2)
+        lines.close()
+
+    def testExitStatus(self):
+        command = RunningCommand("seq 2; exit 3")
+        try:
+            command.result()
+            self.fail("Expected CalledProcessError")
+        except subprocess.CalledProcessError, e:
+            self.assertEqual(e.returncode, 3)
+
+    def testExitStatusAfterLines(self):
+        lines = []
+        try:
+            for line in RunningCommand("seq 2; exit 1").lines():
+                lines.append(line)
+            self.fail("Expected CalledProcessError")
+        except subprocess.CalledProcessError, e:
+            self.assertEqual(e.returncode, 1)
+        self.assertEqual(lines, ["1", "2"])
+
+    def testTimeoutKillsProcessGroup(self):
+        command = RunningCommand("sleep 30 & echo $!; wait", timeout=0.3)
+        lines = command.lines()
+        child = int(lines.next())
+        self.assertTrue(is_running(child))
+
+        start = time.time()
+        self.assertRaises(CommandTimeoutError, list, lines)
+        self.assertTrue(time.time() - start < 5)
+        self.assertTrue(command.timedOut)
+
+        deadline = time.time() + 5
+        while is_running(child) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(is_running(child))
+
+    def testResultWaitLimit(self):
+        command = RunningCommand("sleep 30")
+        try:
+            self.assertRaises(CommandTimeoutError, command.result, 0.2)
+        finally:
+            command.kill()
+
+    def testAsyncResult(self):
+        first = RunningCommand("sleep 0.3; echo a")
+        second = RunningCommand("sleep 0.3; echo b")
+        self.assertFalse(first.done())
+
+        start = time.time()
+        self.assertEqual(first.result(), "a")
+        self.assertEqual(second.result(), "b")
+        # Both ran at the same time
+        self.assertTrue(time.time() - start < 0.55)
+        self.assertTrue(first.done() and second.done())
+        self.assertEqual(first.retCode, 0)
+
+    def testCancelledScriptKillsCommand(self):
+        pool = WorkerPool("Test", 1)
+        scheduler = ScriptScheduler(pool)
+        commands = []
+        errors = []
+
+        def run(job):
+            commands.append(RunningCommand("sleep 30"))
+            try:
+                commands[0].result()
+            except ScriptCancelled, e:
+                errors.append(e)
+
+        try:
+            job = scheduler.submit("s", "S", run)
+            time.sleep(0.2)
+            scheduler.cancel(job.id)
+            deadline = time.time() + 5
+            while not commands[0].done() and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(commands[0].done())
+            self.assertEqual(len(errors), 1)
+        finally:
+            pool.shutdown()
@@ -0,0 +1,69 @@
+import threading, unittest
+
+from lib.executor import *
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def testSerialLaneKeepsOrder(self):
+        pool = WorkerPool("Test", 1)
+        results = []
+        for i in range(50):
+            pool.submit(results.append, i)
+        pool.shutdown()
+        self.assertEqual(results, range(50))
+
+    def testWorkersRunConcurrently(self):
+        pool = WorkerPool("Test", 2)
+        started = threading.Event()
+        release = threading.Event()
+        done = threading.Event()
+
+        def blocker():
+            started.set()
+            release.wait(5)
+
+        pool.submit(blocker)
+        started.wait(5)
+        pool.submit(done.set)
+        self.assertTrue(done.wait(5))
+        release.set()
+        pool.shutdown()
+
+    def testStats(self):
+        pool = WorkerPool("Test", 1)
+        release = threading.Event()
+        pool.submit(release.wait, 5)
+        pool.submit(lambda: 1 / 0)
+        pool.submit(lambda: None)
+        self.assertTrue(pool.get_queue_depth() >= 2)
+        release.set()
+        pool.shutdown()
+
+        stats = pool.get_stats()
+        self.assertEqual(stats["submitted"], 3)
+        self.assertEqual(stats["completed"], 3)
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual(stats["queued"], 0)
+        self.assertTrue(stats["peakQueued"] >= 2)
+
+    def testFutureResult(self):
+        pool = WorkerPool("Test", 2)
+        release = threading.Event()
+        slow = pool.submit_future(lambda: release.wait(5) and "slow")
+        fast = pool.submit_future(lambda x: x * 2, 21)
+        failed = pool.submit_future(lambda: 1 / 0)
+
+        self.assertEqual(fast.result(5), 42)
+        self.assertRaises(TimeoutError, slow.result, 0.01)
+        self.assertFalse(slow.done())
+        release.set()
+        self.assertEqual(slow.result(5), "slow")
+        self.assertRaises(ZeroDivisionError, failed.result, 5)
+        pool.shutdown()
+
+        self.assertRaises(RuntimeError, pool.submit_future(lambda: None).result, 0)
+
+    def testSubmitAfterShutdown(self):
+        pool = WorkerPool("Test", 1)
+        pool.shutdown()
+        self.assertFalse(pool.submit(lambda: None))
@@ -0,0 +1,54 @@
+import os, shutil, tempfile, time, unittest
+
+from lib.filecache import *
+
+class FileContentsCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = FileContentsCache(maxBytes=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, contents, mtime=None):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as outputFile:
+            outputFile.write(contents)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def testRewrittenFileIsReadAgain(self):
+        now = time.time()
+        path = self.write("a", "first", now - 10)
+        self.assertEqual(self.cache.read(path), "first")
+
+        # Same size, so only the modification time tells the contents apart
+        self.write("a", "again", now)
+        self.assertEqual(self.cache.read(path), "again")
+        self.assertEqual(self.cache.cachedBytes, 5)
+
+    def testCachedContentsNotCopied(self):
+        path = self.write("file", "x" * 60)
+        contents = self.cache.read(path)
+        self.assertEqual(contents, "x" * 60)
+        self.assertTrue(self.cache.read(path) is contents)
+
+    def testEvictsLeastRecentlyUsed(self):
+        first = self.write("first", "1" * 40)
+        second = self.write("second", "2" * 40)
+        third = self.write("third", "3" * 40)
+        self.cache.read(first)
+        self.cache.read(second)
+        self.cache.read(first)
+        self.cache.read(third)
+
+        self.assertEqual(list(self.cache.entries), [first, third])
+        self.assertEqual(self.cache.cachedBytes, 80)
+
+    def testFileOverBudgetNotCached(self):
+        path = self.write("huge", "h" * 150)
+        self.assertEqual(self.cache.read(path), "h" * 150)
+        self.assertEqual(len(self.cache.entries), 0)
+        self.assertEqual(self.cache.cachedBytes, 0)
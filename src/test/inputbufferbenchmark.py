@@ -0,0 +1,53 @@
+"""
+Compares the per-keystroke cost of the old list-based input stack with InputBuffer.
+
+Run from the src directory using: python -m test.inputbufferbenchmark
+"""
+
+import timeit
+
+from lib.matcher import InputBuffer
+
+MAX_STACK_LENGTH = 150
+KEYSTROKES = 20000
+TEXT = u"The quick brown fox jumps over the lazy dog, then types brb and OTOH. "
+ABBREVIATIONS = [u"brb", u"otoh", u"adr", u"sig"]
+
+def list_stack(abbreviations=ABBREVIATIONS):
+    stack = []
+    for i in xrange(KEYSTROKES):
+        stack.append(TEXT[i % len(TEXT)])
+        if len(stack) > MAX_STACK_LENGTH:
+            stack.pop(0)
+        buffer = ''.join(stack)
+        for abbr in abbreviations:
+            buffer.rpartition(abbr)
+            buffer.lower().rpartition(abbr)
+
+def input_buffer(abbreviations=ABBREVIATIONS):
+    buffer = InputBuffer(MAX_STACK_LENGTH)
+    for i in xrange(KEYSTROKES):
+        buffer.append(TEXT[i % len(TEXT)])
+        bufferLen = len(buffer)
+        for abbr in abbreviations:
+            buffer.endswith(abbr) or buffer.endswith(abbr, 0, bufferLen - 1)
+            folded = buffer.lower()
+            folded.endswith(abbr) or folded.endswith(abbr, 0, bufferLen - 1)
+
+def main():
+    # With the abbreviation matcher in place most keystrokes have no candidates to
+    # check, so the buffer upkeep alone is reported as well as the full check. Runs
+    # are interleaved and the best kept, as single runs vary a lot between machines.
+    best = {}
+    for i in xrange(15):
+        for label, abbreviations in (("upkeep only", []), ("check all", ABBREVIATIONS)):
+            for name, func in (("list", list_stack), ("InputBuffer", input_buffer)):
+                seconds = timeit.timeit(lambda: func(abbreviations), number=1)
+                best[(label, name)] = min(best.get((label, name), seconds), seconds)
+
+    for label in ("upkeep only", "check all"):
+        for name in ("list", "InputBuffer"):
+            print "%-12s %-12s %8.2f us/key" % (label, name, best[(label, name)] * 1000000 / KEYSTROKES)
+
+if __name__ == "__main__":
+    main()
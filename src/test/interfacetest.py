@@ -67,4 +67,118 @@ class MockService:
         self.key = key
 
     
-    
\ No newline at end of file
+    
+
+class FakeProperty:
+
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeWindow:
+
+    def __init__(self, id, properties=None):
+        self.id = id
+        self.properties = properties or {}
+        self.reads = 0
+
+    def get_full_property(self, atom, propertyType):
+        self.reads += 1
+        if atom in self.properties:
+            return FakeProperty(self.properties[atom])
+        return None
+
+    def change_attributes(self, event_mask=None, onerror=None):
+        pass
+
+
+class FakeDisplay:
+
+    def __init__(self):
+        self.atoms = {}
+
+    def intern_atom(self, name, onlyIfExists=False):
+        return self.atoms.setdefault(name, 1000 + len(self.atoms))
+
+    def create_resource_object(self, kind, id):
+        return FakeWindow(id)
+
+    def flush(self):
+        pass
+
+
+class FakeEvent:
+
+    def __init__(self, type, window, atom=None):
+        self.type = type
+        self.window = window
+        self.atom = atom
+
+
+class WindowTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.display = FakeDisplay()
+        self.titles = {1: "one", 2: "two"}
+        self.reads = []
+        self.table = interface.WindowTable(self.display, self.getTitle, self.getClass)
+        self.clientListAtom = self.display.intern_atom("_NET_CLIENT_LIST")
+        self.root = FakeWindow(0, {self.clientListAtom: [1, 2]})
+
+    def getTitle(self, window, traverse):
+        self.reads.append(window.id)
+        return self.titles[window.id]
+
+    def getClass(self, window, traverse):
+        return "class%d" % window.id
+
+    def getWindows(self):
+        return self.table.get_windows(self.display, self.root)
+
+    def testWindowsReadOnce(self):
+        self.assertEqual(self.getWindows(), [("one", "class1"), ("two", "class2")])
+        self.assertEqual(self.getWindows(), [("one", "class1"), ("two", "class2")])
+        self.assertEqual(self.reads, [1, 2])
+        # Without a change event, the client list itself is not read again either
+        self.assertEqual(self.root.reads, 1)
+
+    def testTitleChangeRereadsWindow(self):
+        self.getWindows()
+        self.titles[2] = "renamed"
+        self.table.handle_event(FakeEvent(interface.X.PropertyNotify, FakeWindow(2), interface.Xatom.WM_NAME), self.root)
+
+        self.assertEqual(self.getWindows(), [("one", "class1"), ("renamed", "class2")])
+        self.assertEqual(self.reads, [1, 2, 2])
+
+    def testUnwatchedPropertyIgnored(self):
+        self.getWindows()
+        self.titles[2] = "renamed"
+        self.table.handle_event(FakeEvent(interface.X.PropertyNotify, FakeWindow(2), interface.Xatom.WM_ICON_NAME), self.root)
+
+        self.assertEqual(self.getWindows(), [("one", "class1"), ("two", "class2")])
+
+    def testClientListChange(self):
+        self.getWindows()
+        listReads = self.root.reads
+        self.titles[3] = "three"
+        self.root.properties[self.clientListAtom] = [2, 3]
+        self.table.handle_event(FakeEvent(interface.X.PropertyNotify, self.root, self.clientListAtom), self.root)
+
+        self.assertEqual(self.getWindows(), [("two", "class2"), ("three", "class3")])
+        self.assertEqual(self.root.reads, listReads + 1)
+        # Windows still listed keep their cached title
+        self.assertEqual(self.reads, [1, 2, 3])
+
+    def testCreateAndDestroyReloadList(self):
+        for eventType in (interface.X.CreateNotify, interface.X.DestroyNotify):
+            self.getWindows()
+            listReads = self.root.reads
+            self.table.handle_event(FakeEvent(eventType, FakeWindow(5)), self.root)
+            self.getWindows()
+            self.assertEqual(self.root.reads, listReads + 1)
+
+    def testReset(self):
+        self.getWindows()
+        self.table.reset()
+        self.getWindows()
+        self.assertEqual(self.reads, [1, 2, 1, 2])
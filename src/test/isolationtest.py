@@ -0,0 +1,123 @@
+import os, threading, time, unittest
+
+from lib.isolation import *
+from lib.executor import WorkerPool
+from lib.scheduler import ScriptScheduler
+
+class Recorder:
+
+    def __init__(self):
+        self.calls = []
+
+    def send_keys(self, keys):
+        self.calls.append(keys)
+        return len(keys)
+
+    def fail(self):
+        raise ValueError("bad value")
+
+
+class IsolatedScriptPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = IsolatedScriptPool(1, {"__builtins__": __builtins__})
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def testRunsInWorkerProcess(self):
+        recorder = Recorder()
+        self.pool.run("import os\nkeyboard.send_keys(str(os.getpid()))", {"keyboard": recorder})
+        self.assertEqual(len(recorder.calls), 1)
+        self.assertNotEqual(recorder.calls[0], str(os.getpid()))
+
+    def testProxiedResults(self):
+        recorder = Recorder()
+        source = "n = keyboard.send_keys('abc')\nkeyboard.send_keys('x' * n)"
+        self.pool.run(source, {"keyboard": recorder})
+        self.assertEqual(recorder.calls, ["abc", "xxx"])
+
+    def testProxiedError(self):
+        recorder = Recorder()
+        source = "try:\n    keyboard.fail()\nexcept Exception, e:\n    keyboard.send_keys(str(e))"
+        self.pool.run(source, {"keyboard": recorder})
+        self.assertEqual(recorder.calls, ["ValueError: bad value"])
+
+    def testScriptError(self):
+        self.assertRaises(IsolatedScriptError, self.pool.run, "1 / 0", {})
+        # The worker is still usable afterwards
+        recorder = Recorder()
+        self.pool.run("keyboard.send_keys('ok')", {"keyboard": recorder})
+        self.assertEqual(recorder.calls, ["ok"])
+
+    def testDeadWorkerNotReplaced(self):
+        pool = IsolatedScriptPool(2, {"__builtins__": __builtins__})
+        try:
+            self.assertRaises(IsolatedScriptError, pool.run, "import os\nos._exit(1)", {})
+            self.assertEqual(len(pool.workers), 1)
+            recorder = Recorder()
+            pool.run("keyboard.send_keys('ok')", {"keyboard": recorder})
+            self.assertEqual(recorder.calls, ["ok"])
+        finally:
+            pool.shutdown()
+
+    def testLastWorkerExited(self):
+        busy = threading.Thread(target=self.assertRaises,
+                                args=(IsolatedScriptError, self.pool.run, "import os, time\ntime.sleep(0.2)\nos._exit(1)", {}))
+        busy.start()
+        time.sleep(0.1)
+        # Waits for the busy worker, then fails instead of waiting forever
+        self.assertRaises(IsolatedScriptError, self.pool.run, "pass", {})
+        busy.join(5)
+        self.assertEqual(self.pool.workers, [])
+
+    def testCancelAfterRunLeavesWorker(self):
+        pool = WorkerPool("Test", 1)
+        scheduler = ScriptScheduler(pool)
+        finished = threading.Event()
+        proceed = threading.Event()
+
+        def run(job):
+            self.pool.run("pass", {}, job.set_canceller)
+            finished.set()
+            proceed.wait(5)
+
+        try:
+            job = scheduler.submit("s", "S", run)
+            finished.wait(5)
+            worker = self.pool.workers[0]
+            # The script is done, so its worker must not be terminated
+            scheduler.cancel(job.id)
+            proceed.set()
+            time.sleep(0.1)
+            self.assertTrue(worker.process.is_alive())
+            self.assertEqual(self.pool.workers, [worker])
+        finally:
+            proceed.set()
+            pool.shutdown()
+
+    def testCancelWhileWaitingForWorker(self):
+        busy = threading.Thread(target=self.pool.run, args=("import time\ntime.sleep(1)", {}))
+        busy.start()
+        time.sleep(0.1)
+
+        stoppers = []
+        errors = []
+        def wait():
+            try:
+                self.pool.run("pass", {}, stoppers.append)
+            except IsolatedScriptError, e:
+                errors.append(e)
+
+        waiting = threading.Thread(target=wait)
+        waiting.start()
+        time.sleep(0.1)
+        stoppers[0]()
+        waiting.join(0.5)
+        # Stopped before the busy worker became free
+        self.assertFalse(waiting.isAlive())
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(stoppers[1:], [None])
+
+        busy.join(5)
+        self.assertEqual(len(self.pool.idle), 1)
@@ -0,0 +1,50 @@
+import unittest
+
+from lib.latency import *
+
+class RollingHistogramTest(unittest.TestCase):
+
+    def testStats(self):
+        histogram = RollingHistogram()
+        for ms in range(1, 101):
+            histogram.add(ms / 1000.0)
+
+        stats = histogram.get_stats()
+        self.assertEqual(stats["count"], 100)
+        self.assertAlmostEqual(stats["mean"], 50.5)
+        self.assertAlmostEqual(stats["p50"], 51)
+        self.assertAlmostEqual(stats["p99"], 100)
+        self.assertAlmostEqual(stats["max"], 100)
+        self.assertEqual(stats["le_1"], 1)
+        self.assertEqual(stats["le_10"], 10)
+        self.assertEqual(stats["le_100"], 100)
+        self.assertEqual(stats["le_inf"], 100)
+
+    def testWindow(self):
+        histogram = RollingHistogram(10)
+        for i in range(25):
+            histogram.add(i)
+        stats = histogram.get_stats()
+        self.assertEqual(stats["count"], 10)
+        self.assertEqual(stats["total"], 25)
+        self.assertAlmostEqual(stats["p50"], 20000)
+
+    def testEmpty(self):
+        stats = RollingHistogram().get_stats()
+        self.assertEqual(stats["count"], 0)
+        self.assertEqual(stats["p99"], 0)
+
+class LatencyRecorderTest(unittest.TestCase):
+
+    def testRecord(self):
+        recorder = LatencyRecorder()
+        recorder.record(MATCH, 0.002)
+        end = recorder.record_since(TOTAL, now())
+        self.assertTrue(end <= now())
+
+        stats = recorder.get_stats()
+        self.assertEqual(sorted(stats.keys()), [MATCH, TOTAL])
+        self.assertAlmostEqual(stats[MATCH]["max"], 2)
+
+        recorder.reset()
+        self.assertEqual(recorder.get_stats(), {})
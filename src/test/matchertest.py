@@ -0,0 +1,219 @@
+import re, unittest
+
+from lib.matcher import *
+
+class Target:
+
+    def __init__(self, name, abbreviations, ignoreCase=False):
+        self.name = name
+        self.abbreviations = abbreviations
+        self.ignoreCase = ignoreCase
+
+    def __repr__(self):
+        return self.name
+
+class AbbreviationIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.brb = Target("brb", ["brb"])
+        self.rb = Target("rb", ["rb"])
+        self.multi = Target("multi", ["adr", "addr"])
+        self.nocase = Target("nocase", ["otoh"], True)
+        self.folder = Target("folder", ["f@"])
+        self.index = AbbreviationIndex([self.folder], [self.brb, self.rb, self.multi, self.nocase])
+
+    def testImmediateEnd(self):
+        folders, items = self.index.get_candidates("xxbrb")
+        self.assertEqual(folders, [])
+        self.assertEqual(items, [self.brb, self.rb])
+
+    def testTriggerCharEnd(self):
+        folders, items = self.index.get_candidates("brb ")
+        self.assertEqual(items, [self.brb, self.rb])
+
+        folders, items = self.index.get_candidates("brb  ")
+        self.assertEqual(items, [])
+
+    def testMultipleAbbreviations(self):
+        self.assertEqual(self.index.get_candidates("addr")[1], [self.multi])
+        self.assertEqual(self.index.get_candidates("adr.")[1], [self.multi])
+
+    def testIgnoreCase(self):
+        self.assertEqual(self.index.get_candidates("OtOh ")[1], [self.nocase])
+        self.assertEqual(self.index.get_candidates("BRB ")[1], [])
+
+    def testFolders(self):
+        folders, items = self.index.get_candidates("f@")
+        self.assertEqual(folders, [self.folder])
+        self.assertEqual(items, [])
+
+    def testShortBuffers(self):
+        self.assertEqual(self.index.get_candidates(""), ([], []))
+        self.assertEqual(self.index.get_candidates("b"), ([], []))
+
+    def testOverlappingAbbreviations(self):
+        index = AbbreviationIndex([], [Target("a", ["abcd"]), Target("b", ["bc"]), Target("c", ["c"])])
+        self.assertEqual([t.name for t in index.get_candidates("xabc")[1]], ["b", "c"])
+        self.assertEqual([t.name for t in index.get_candidates("abcd")[1]], ["a", "b", "c"])
+
+class AbbreviationMatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.brb = Target("brb", ["brb"])
+        self.nocase = Target("nocase", ["otoh"], True)
+        self.index = AbbreviationIndex([], [self.brb, self.nocase])
+        self.matcher = AbbreviationMatcher(10)
+        self.stack = []
+        self.matcher.set_index(self.index, self.stack)
+
+    def type(self, string):
+        for char in string:
+            self.stack.append(char)
+            self.matcher.append(char)
+
+    def testAppend(self):
+        self.type("xbr")
+        self.assertEqual(self.matcher.get_candidates(), ([], []))
+        self.type("b")
+        self.assertEqual(self.matcher.get_candidates()[1], [self.brb])
+        self.type(" ")
+        self.assertEqual(self.matcher.get_candidates()[1], [self.brb])
+        self.type(" ")
+        self.assertEqual(self.matcher.get_candidates()[1], [])
+
+    def testBackspace(self):
+        self.type("brx")
+        self.matcher.backspace()
+        self.stack.pop()
+        self.type("b")
+        self.assertEqual(self.matcher.get_candidates()[1], [self.brb])
+
+    def testClear(self):
+        self.type("OTO")
+        self.matcher.clear()
+        self.type("h")
+        self.assertEqual(self.matcher.get_candidates(), ([], []))
+
+    def testIndexChanged(self):
+        self.type("adr")
+        adr = Target("adr", ["adr"])
+        self.matcher.set_index(AbbreviationIndex([], [adr]), self.stack)
+        self.assertEqual(self.matcher.get_candidates()[1], [adr])
+
+    def testAgainstBufferScan(self):
+        index = AbbreviationIndex([], [Target("aa", ["aa"]), Target("aba", ["aba"]),
+                                        Target("b", ["B"], True), Target("ab", ["ab"], True)])
+        matcher = AbbreviationMatcher(10)
+        matcher.set_index(index, [])
+        stack = []
+        for char in "abAAbaBabaaBAb":
+            stack.append(char)
+            matcher.append(char)
+            if len(stack) > 10:
+                stack.pop(0)
+            self.assertEqual(matcher.get_candidates(), index.get_candidates(''.join(stack)))
+
+class Hotkey:
+
+    def __init__(self, modifiers, hotKey):
+        self.modifiers = modifiers
+        self.hotKey = hotKey
+
+class HotkeyIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = Hotkey(["<super>"], "k")
+        self.phrase = Hotkey(["<ctrl>"], "k")
+        self.script = Hotkey(["<ctrl>"], "k")
+        self.folder = Hotkey(["<alt>", "<ctrl>"], "<f7>")
+        self.index = HotkeyIndex([self.config], [self.phrase, Hotkey([], None), self.script], [self.folder])
+
+    def testLookup(self):
+        self.assertEqual(self.index.get_candidates(["<super>"], "k"), ([self.config], [], []))
+        self.assertEqual(self.index.get_candidates(["<ctrl>"], "k"), ([], [self.phrase, self.script], []))
+        self.assertEqual(self.index.get_candidates(["<alt>", "<ctrl>"], "<f7>"), ([], [], [self.folder]))
+
+    def testNoMatch(self):
+        self.assertEqual(self.index.get_candidates([], "k"), ((), (), ()))
+        self.assertEqual(self.index.get_candidates(["<ctrl>"], "j"), ((), (), ()))
+
+class Filtered:
+
+    def __init__(self, regex):
+        self.regex = regex is not None and re.compile(regex, re.UNICODE) or None
+
+    def get_applicable_regex(self):
+        return self.regex
+
+class WindowFilterIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.anywhere = Filtered(None)
+        self.gedit = Filtered(".* - gedit")
+        self.gedit2 = Filtered(".* - gedit")
+        self.term = Filtered("gnome-terminal.*")
+        self.index = WindowFilterIndex([self.anywhere, self.gedit, self.gedit2, self.term], 2)
+
+    def testScope(self):
+        scope = self.index.get_scope(("notes - gedit", "gedit.Gedit"))
+        self.assertEqual(scope.filter([self.anywhere, self.gedit, self.term, self.gedit2]),
+                         [self.anywhere, self.gedit, self.gedit2])
+
+        scope = self.index.get_scope(("Terminal", "gnome-terminal.Gnome-terminal"))
+        self.assertTrue(scope.allows(self.term))
+        self.assertFalse(scope.allows(self.gedit))
+        self.assertTrue(scope.allows(self.anywhere))
+
+    def testCache(self):
+        first = self.index.get_scope(("a", "b"))
+        self.assertTrue(self.index.get_scope(("a", "b")) is first)
+        self.index.get_scope(("c", "d"))
+        self.assertTrue(self.index.get_scope(("a", "b")) is first)
+        self.index.get_scope(("e", "f"))
+        self.index.get_scope(("g", "h"))
+        self.assertFalse(self.index.get_scope(("a", "b")) is first)
+
+    def testNoFilters(self):
+        index = WindowFilterIndex([self.anywhere])
+        self.assertEqual(index.get_scope(("a", "b")).filter([self.anywhere]), [self.anywhere])
+
+class InputBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.buffer = InputBuffer(5)
+
+    def type(self, string):
+        for char in string:
+            self.buffer.append(char)
+
+    def testAppendWraps(self):
+        self.type(u"abcdefg")
+        self.assertEqual(len(self.buffer), 5)
+        self.assertEqual(self.buffer.get_string(), u"cdefg")
+        self.assertEqual(self.buffer[0], u"c")
+        self.assertEqual(self.buffer[-1], u"g")
+        self.assertRaises(IndexError, lambda: self.buffer[5])
+
+    def testPopAndClear(self):
+        self.type(u"abcdefg")
+        self.assertEqual(self.buffer.pop(), u"g")
+        self.assertEqual(self.buffer.get_string(), u"cdef")
+        self.type(u"xy")
+        self.assertEqual(self.buffer.get_string(), u"defxy")
+        self.buffer.clear()
+        self.assertEqual(len(self.buffer), 0)
+        self.assertRaises(IndexError, self.buffer.pop)
+
+    def testEndswith(self):
+        self.type(u"xxbrb ")
+        for suffix in (u"", u" ", u"b ", u"brb ", u"rb", u"xbrb ", u"abrb "):
+            for end in (None, -1, 4, 0):
+                string = self.buffer.get_string()
+                self.assertEqual(self.buffer.endswith(suffix, 0, end), string.endswith(suffix, 0, end))
+
+    def testLower(self):
+        self.type(u"xxOtOh")
+        folded = self.buffer.lower()
+        self.assertTrue(folded.endswith(u"otoh"))
+        self.assertFalse(self.buffer.endswith(u"otoh"))
+        self.assertEqual(folded, u"xotoh")
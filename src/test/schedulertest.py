@@ -0,0 +1,164 @@
+import threading, time, unittest
+
+from lib.executor import WorkerPool
+from lib.scheduler import *
+
+class ScriptSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool("Test", 4)
+        self.scheduler = ScriptScheduler(self.pool)
+        self.release = threading.Event()
+        self.runs = []
+
+    def tearDown(self):
+        self.release.set()
+        self.pool.shutdown()
+
+    def blocker(self, job, name):
+        self.runs.append(name)
+        self.release.wait(5)
+
+    def spinner(self, job):
+        # Stands in for a script calling the scripting API in a loop
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            check_cancelled()
+        self.runs.append("not cancelled")
+
+    def waitUntil(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.005)
+        self.assertTrue(condition())
+
+    def testDropPolicy(self):
+        self.scheduler.submit("s", "S", self.blocker, ("first",), 1, RetriggerPolicy.DROP)
+        self.assertEqual(self.scheduler.submit("s", "S", self.blocker, ("second",), 1, RetriggerPolicy.DROP), None)
+        self.release.set()
+        self.waitUntil(lambda: len(self.scheduler.list_jobs()) == 0)
+        self.assertEqual(self.runs, ["first"])
+
+    def testQueuePolicy(self):
+        self.scheduler.submit("s", "S", self.blocker, ("first",), 1, RetriggerPolicy.QUEUE)
+        self.scheduler.submit("s", "S", self.blocker, ("second",), 1, RetriggerPolicy.QUEUE)
+        self.waitUntil(lambda: self.runs == ["first"])
+        states = sorted(state for jobId, name, state, seconds in self.scheduler.list_jobs())
+        self.assertEqual(states, ["queued", "running"])
+
+        self.release.set()
+        self.waitUntil(lambda: len(self.scheduler.list_jobs()) == 0)
+        self.assertEqual(self.runs, ["first", "second"])
+
+    def testRestartPolicy(self):
+        self.scheduler.submit("s", "S", self.spinner, (), 1, RetriggerPolicy.RESTART)
+        self.waitUntil(lambda: self.scheduler.list_jobs()[0][2] == "running")
+        self.scheduler.submit("s", "S", self.blocker, ("second",), 1, RetriggerPolicy.RESTART)
+        self.waitUntil(lambda: self.runs == ["second"])
+        self.release.set()
+        self.waitUntil(lambda: len(self.scheduler.list_jobs()) == 0)
+        self.assertEqual(self.runs, ["second"])
+
+    def testTimeout(self):
+        job = self.scheduler.submit("s", "S", self.spinner, (), timeout=0.05)
+        self.waitUntil(lambda: len(self.scheduler.list_jobs()) == 0)
+        self.assertEqual(self.runs, [])
+        self.assertTrue(job.cancelReason.startswith("timed out"))
+
+    def testDefaultTimeout(self):
+        job = self.scheduler.submit("s", "S", self.spinner, (), timeout=None, defaultTimeout=0.05)
+        self.waitUntil(lambda: len(self.scheduler.list_jobs()) == 0)
+        self.assertEqual(job.cancelReason, "timed out after 0.05s")
+
+    def testNoTimeoutOverridesDefault(self):
+        job = self.scheduler.submit("s", "S", self.blocker, ("first",), timeout=0, defaultTimeout=0.05)
+        self.waitUntil(lambda: self.runs == ["first"])
+        time.sleep(0.2)
+        self.assertFalse(job.is_cancelled())
+        self.release.set()
+        self.waitUntil(lambda: len(self.scheduler.list_jobs()) == 0)
+        self.assertFalse(job.is_cancelled())
+
+    def testCancelWithCanceller(self):
+        cancelled = threading.Event()
+
+        def run(job):
+            job.set_canceller(cancelled.set)
+            cancelled.wait(5)
+
+        job = self.scheduler.submit("s", "S", run)
+        self.waitUntil(lambda: job.canceller is not None)
+        self.assertTrue(self.scheduler.cancel(job.id))
+        self.waitUntil(lambda: len(self.scheduler.list_jobs()) == 0)
+        self.assertTrue(cancelled.isSet())
+        self.assertFalse(self.scheduler.cancel(job.id))
+
+    def testCancelAfterCancellerWithdrawn(self):
+        calls = []
+        withdrawn = threading.Event()
+
+        def run(job):
+            job.set_canceller(lambda: calls.append("cancelled"))
+            job.set_canceller(None)
+            withdrawn.set()
+            self.release.wait(5)
+            self.runs.append("finished")
+
+        job = self.scheduler.submit("s", "S", run)
+        withdrawn.wait(5)
+        self.assertTrue(self.scheduler.cancel(job.id))
+        self.release.set()
+        self.waitUntil(lambda: len(self.scheduler.list_jobs()) == 0)
+        self.assertEqual(calls, [])
+        self.assertEqual(self.runs, ["finished"])
+
+    def testUnlimitedRunsConcurrently(self):
+        for i in range(3):
+            self.scheduler.submit("s", "S", self.blocker, (i,))
+        self.waitUntil(lambda: len(self.runs) == 3)
+
+    def testRestartWaitsForCancelledRun(self):
+        stopping = threading.Event()
+
+        def slowToStop(job):
+            self.runs.append("first")
+            while not job.is_cancelled():
+                time.sleep(0.005)
+            stopping.wait(5)
+
+        self.scheduler.submit("s", "S", slowToStop, (), 1, RetriggerPolicy.RESTART)
+        self.waitUntil(lambda: self.runs == ["first"])
+        self.scheduler.submit("s", "S", self.blocker, ("second",), 1, RetriggerPolicy.RESTART)
+        self.scheduler.submit("s", "S", self.blocker, ("third",), 1, RetriggerPolicy.RESTART)
+        time.sleep(0.1)
+        # Only one run at a time, and only the latest restart replaces it
+        self.assertEqual(self.runs, ["first"])
+        states = sorted(state for jobId, name, state, seconds in self.scheduler.list_jobs())
+        self.assertEqual(states, ["queued", "stopping"])
+
+        stopping.set()
+        self.waitUntil(lambda: self.runs == ["first", "third"])
+        self.release.set()
+        self.waitUntil(lambda: len(self.scheduler.list_jobs()) == 0)
+
+    def testCheckedObject(self):
+        calls = []
+        checked = CheckedObject(self)
+        started = threading.Event()
+
+        def run(job):
+            checked.runs.append("before")
+            started.set()
+            self.release.wait(5)
+            try:
+                checked.blocker(job, "after")
+            except ScriptCancelled:
+                calls.append("stopped")
+
+        job = self.scheduler.submit("s", "S", run)
+        started.wait(5)
+        self.scheduler.cancel(job.id)
+        self.release.set()
+        self.waitUntil(lambda: len(self.scheduler.list_jobs()) == 0)
+        self.assertEqual(self.runs, ["before"])
+        self.assertEqual(calls, ["stopped"])
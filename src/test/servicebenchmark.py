@@ -0,0 +1,321 @@
+"""
+Replays keystroke streams through Service.handle_keypress against generated configurations
+and reports per-key latency, expansion throughput and memory use.
+
+No X server is needed: the IoMediator, its interface, the script runner and the application
+are replaced by mocks, so only the keypress handling, matching and expansion code is timed.
+
+Run from the src directory using: python -m test.servicebenchmark [options]
+
+Examples:
+    python -m test.servicebenchmark --sizes 100,1000,10000,100000
+    python -m test.servicebenchmark --input typed.txt --max-p99 2.0
+"""
+
+import sys, time, random, resource, optparse, timeit
+
+from lib import service
+from lib.configmanager import ConfigManager, ConfigSnapshot, SERVICE_RUNNING, UNDO_USING_BACKSPACE
+from lib.iomediator import Key, KEY_SPLIT_RE
+from lib.model import Folder, Phrase, Script, TriggerMode
+
+DEFAULT_SIZES = "100,1000,10000,100000"
+DEFAULT_KEYSTROKES = 20000
+ITEMS_PER_FOLDER = 50
+WINDOW = (u"notes.txt - gedit", u"gedit.Gedit")
+WORDS = u"the quick brown fox jumps over lazy dog and then types some more text into a window".split()
+DRAIN_TIMEOUT = 30.0
+
+
+class MockInterface:
+
+    def begin_send(self):
+        pass
+
+    def finish_send(self):
+        pass
+
+
+class MockMediator:
+    """
+    Stands in for IoMediator, recording output instead of sending it to X.
+    """
+
+    def __init__(self):
+        self.interface = MockInterface()
+        self.expansions = 0
+        self.charsSent = 0
+
+    def send_backspace(self, count):
+        self.charsSent += count
+
+    def send_string(self, string):
+        self.send_compiled(self.compile_string(string))
+
+    def compile_string(self, string):
+        return (string,)
+
+    def send_compiled(self, ops):
+        self.charsSent += sum(len(op) for op in ops)
+        self.expansions += 1
+
+    def paste_string(self, string, pasteCommand):
+        self.send_string(string)
+
+    def remove_string(self, string):
+        self.charsSent += len(string)
+
+
+class MockScriptRunner:
+    """
+    Counts script executions rather than running the script code.
+    """
+
+    def __init__(self, mediator):
+        self.mediator = mediator
+        self.engine = None
+        self.error = ''
+        self.executed = 0
+
+    def execute(self, script, buffer=''):
+        self.executed += 1
+        self.mediator.expansions += 1
+
+
+class MockConfigManager:
+
+    def __init__(self, folders):
+        self.folders = folders
+        self.snapshot = ConfigSnapshot(folders, [])
+        self.allFolders = self.snapshot.allFolders
+        self.allItems = self.snapshot.allItems
+
+
+class MockApp:
+
+    def __init__(self, configManager):
+        self.configManager = configManager
+        self.menus = 0
+
+    def show_popup_menu(self, folders=[], items=[], onDesktop=True, title=None):
+        self.menus += 1
+
+    def hide_menu(self):
+        pass
+
+    def notify_error(self, message):
+        pass
+
+
+def make_abbreviation(n):
+    """
+    @return: a unique abbreviation for the given item number
+    """
+    letters = u""
+    n += 26 * 26
+    while n:
+        n, rem = divmod(n, 26)
+        letters = unichr(ord(u'a') + rem) + letters
+    return u"z" + letters
+
+
+def generate_config(size, seed=0):
+    """
+    Generate a folder tree holding the given number of phrases and scripts.
+
+    Most items are abbreviation phrases. Some are scripts or hotkey-only phrases, some
+    trigger immediately, and some folders carry a window filter or an abbreviation of
+    their own.
+
+    @return: a tuple of the top-level folders and the abbreviations that trigger an item
+    """
+    rand = random.Random(seed)
+    folders = []
+    abbreviations = []
+    folder = None
+
+    for n in xrange(size):
+        if n % ITEMS_PER_FOLDER == 0:
+            folder = Folder(u"Folder %d" % len(folders))
+            if rand.random() < 0.1:
+                folder.set_window_titles(u".*terminal.*")
+            if rand.random() < 0.02:
+                folder.add_abbreviation(u"fold%d" % len(folders))
+                folder.set_modes([TriggerMode.ABBREVIATION])
+            folders.append(folder)
+
+        kind = rand.random()
+        if kind < 0.1:
+            item = Script(u"Script %d" % n, u"store.set_value('n', %d)" % n)
+        else:
+            item = Phrase(u"Phrase %d" % n, u"Expanded text for phrase number %d" % n)
+
+        if kind > 0.9:
+            item.set_hotkey([Key.CONTROL, Key.ALT], u"<f%d>" % (n % 12 + 1))
+            item.modes = [TriggerMode.HOTKEY]
+        else:
+            abbr = make_abbreviation(n)
+            item.add_abbreviation(abbr)
+            item.immediate = rand.random() < 0.1
+            item.ignoreCase = rand.random() < 0.2
+            item.modes = [TriggerMode.ABBREVIATION]
+            if folder.windowInfoRegex is None:
+                abbreviations.append(abbr)
+
+        folder.add_item(item)
+
+    return folders, abbreviations
+
+
+def synthetic_keys(abbreviations, count, seed=0):
+    """
+    Generate a stream of typed words, with a known abbreviation typed about once
+    every ten words.
+
+    @return: a list of (modifiers, key) tuples
+    """
+    rand = random.Random(seed)
+    keys = []
+    while len(keys) < count:
+        if abbreviations and rand.random() < 0.1:
+            word = rand.choice(abbreviations)
+        else:
+            word = rand.choice(WORDS)
+            if rand.random() < 0.1:
+                word = word.capitalize()
+        for char in word + u" ":
+            keys.append(char.isupper() and ([Key.SHIFT], char) or ([], char))
+        if rand.random() < 0.02:
+            keys.append(([], Key.BACKSPACE))
+    return keys[:count]
+
+
+def recorded_keys(path):
+    """
+    Read a keystroke stream from a text file. Special keys are written using their
+    names, e.g. <backspace>, and line breaks are sent as <enter>.
+
+    @return: a list of (modifiers, key) tuples
+    """
+    with open(path, "r") as inFile:
+        text = inFile.read().decode("utf-8")
+
+    keys = []
+    for part in KEY_SPLIT_RE.split(text.replace(u"\n", Key.ENTER)):
+        if KEY_SPLIT_RE.match(part):
+            keys.append(([], part))
+        else:
+            for char in part:
+                keys.append(char.isupper() and ([Key.SHIFT], char) or ([], char))
+    return keys
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def get_max_rss():
+    """
+    @return: peak resident set size of this process in KiB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def make_service(folders):
+    app = MockApp(MockConfigManager(folders))
+    s = service.Service(app)
+    s.mediator = MockMediator()
+    s.scriptRunner = MockScriptRunner(s.mediator)
+    s.phraseRunner = service.PhraseRunner(s)
+    ConfigManager.SETTINGS[SERVICE_RUNNING] = True
+    ConfigManager.SETTINGS[UNDO_USING_BACKSPACE] = False
+    return app, s
+
+
+def wait_for_output(s):
+    deadline = time.time() + DRAIN_TIMEOUT
+    while time.time() < deadline:
+        stats = s.outputLane.get_stats()
+        if stats["queued"] == 0 and stats["active"] == 0:
+            return
+        time.sleep(0.001)
+
+
+def run(size, keys=None, keystrokes=DEFAULT_KEYSTROKES, seed=0):
+    """
+    Build a configuration of the given size and replay a keystroke stream against it.
+
+    @return: a dictionary of the measured results
+    """
+    rssBefore = get_max_rss()
+    start = timeit.default_timer()
+    folders, abbreviations = generate_config(size, seed)
+    app, s = make_service(folders)
+    buildTime = timeit.default_timer() - start
+
+    if keys is None:
+        keys = synthetic_keys(abbreviations, keystrokes, seed)
+
+    latencies = []
+    clock = timeit.default_timer
+    start = clock()
+    for modifiers, key in keys:
+        before = clock()
+        s.handle_keypress(key, modifiers, key, WINDOW[0], WINDOW[1])
+        latencies.append(clock() - before)
+    wait_for_output(s)
+    elapsed = clock() - start
+    s.outputLane.shutdown()
+    s.scriptPool.shutdown()
+    s.macroPool.shutdown()
+    if s.isolatedPool is not None: s.isolatedPool.shutdown()
+
+    return {
+            "size": size,
+            "keys": len(keys),
+            "build": buildTime,
+            "p50": percentile(latencies, 0.50),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies),
+            "expansions": s.mediator.expansions,
+            "expansionsPerSec": s.mediator.expansions / elapsed,
+            "menus": app.menus,
+            "rssGrowth": max(0, get_max_rss() - rssBefore)
+            }
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="python -m test.servicebenchmark [options]")
+    parser.add_option("--sizes", default=DEFAULT_SIZES,
+                      help="comma separated configuration sizes [default: %default]")
+    parser.add_option("--keys", type="int", default=DEFAULT_KEYSTROKES,
+                      help="number of synthetic keystrokes per run [default: %default]")
+    parser.add_option("--input", default=None,
+                      help="replay the keystrokes recorded in this file instead")
+    parser.add_option("--seed", type="int", default=0,
+                      help="seed for the generated configuration and keystrokes")
+    parser.add_option("--max-p99", type="float", default=None, dest="maxP99",
+                      help="exit with an error if any run's p99 latency (ms) exceeds this")
+    options, args = parser.parse_args(argv)
+
+    keys = None
+    if options.input is not None:
+        keys = recorded_keys(options.input)
+
+    print "%8s %7s %9s %9s %9s %9s %9s %11s %9s" % ("items", "keys", "build s", "p50 us",
+                        "p99 us", "max us", "expands", "expands/s", "rss KiB")
+    failed = False
+    for size in [int(s) for s in options.sizes.split(",")]:
+        r = run(size, keys, options.keys, options.seed)
+        print "%8d %7d %9.2f %9.1f %9.1f %9.1f %9d %11.1f %9d" % (r["size"], r["keys"], r["build"],
+                        r["p50"] * 1e6, r["p99"] * 1e6, r["max"] * 1e6, r["expansions"],
+                        r["expansionsPerSec"], r["rssGrowth"])
+        if options.maxP99 is not None and r["p99"] * 1000 > options.maxP99:
+            print "p99 latency above %.3f ms for %d items" % (options.maxP99, size)
+            failed = True
+
+    return failed and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main())